@@ -0,0 +1,89 @@
+"""
+Benchmark header updates of suitcase.mongo_embedded as the header collection
+grows.
+
+Every descriptor, resource and count update of a run targets its header
+document. This fills the header collection of a scratch database with
+increasingly many headers and measures the latency of those updates, which
+should stay flat.
+
+Usage:
+
+    python benchmarks/header_updates.py mongodb://localhost:27017/
+"""
+import argparse
+import statistics
+import time
+import uuid
+
+import event_model
+import pymongo
+
+from suitcase.mongo_embedded import Serializer
+
+
+def fill_headers(db, count):
+    """
+    Inserts count headers of finished runs into the header collection.
+    """
+    headers = []
+    for _ in range(count):
+        run_bundle = event_model.compose_run()
+        headers.append({'run_id': run_bundle.start_doc['uid'],
+                        'start': [run_bundle.start_doc],
+                        'stop': [run_bundle.compose_stop()]})
+    if headers:
+        db.header.insert_many(headers)
+
+
+def time_header_updates(db, updates):
+    """
+    Returns the latencies, in seconds, of inserting descriptors into a new
+    run's header.
+    """
+    serializer = Serializer(db)
+    run_bundle = event_model.compose_run()
+    serializer('start', run_bundle.start_doc)
+    latencies = []
+    for i in range(updates):
+        descriptor_bundle = run_bundle.compose_descriptor(
+            name=f'stream{i}',
+            data_keys={'x': {'source': 'x', 'dtype': 'number', 'shape': []}})
+        start = time.perf_counter()
+        serializer('descriptor', descriptor_bundle.descriptor_doc)
+        latencies.append(time.perf_counter() - start)
+    serializer('stop', run_bundle.compose_stop())
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('uri', help="MongoDB URI, without a database")
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[0, 1000, 10000, 100000],
+                        help="header collection sizes to measure at")
+    parser.add_argument('--updates', type=int, default=200,
+                        help="header updates to time at each size")
+    args = parser.parse_args()
+
+    client = pymongo.MongoClient(args.uri)
+    database_name = f'benchmark-{uuid.uuid4()}'
+    db = client[database_name]
+    try:
+        print(f"{'headers':>10} {'median (ms)':>12} {'p99 (ms)':>10}")
+        current_size = 0
+        for size in sorted(args.sizes):
+            fill_headers(db, size - current_size)
+            current_size = size
+            latencies = time_header_updates(db, args.updates)
+            # Each measured run adds one header.
+            current_size += 1
+            p99 = statistics.quantiles(latencies, n=100)[-1]
+            print(f"{size:>10} {statistics.median(latencies) * 1000:>12.3f} "
+                  f"{p99 * 1000:>10.3f}")
+    finally:
+        client.drop_database(database_name)
+
+
+if __name__ == '__main__':
+    main()
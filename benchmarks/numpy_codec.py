@@ -0,0 +1,73 @@
+"""
+Benchmark encoding Events that hold numpy waveforms.
+
+Compares the CPU time of sanitizing each Event with event_model.sanitize_doc
+and then encoding it, which is what the Serializers did before, with
+encoding it directly with suitcase.mongo_utils.NUMPY_CODEC_OPTIONS, which is
+what they do with a pymongo client. No database is needed.
+
+Usage:
+
+    python benchmarks/numpy_codec.py --length 1000
+"""
+import argparse
+import time
+
+import bson
+import event_model
+import numpy
+
+from suitcase.mongo_utils import NUMPY_CODEC_OPTIONS
+
+
+def make_events(count, length):
+    """
+    Returns count Events, each with a waveform of length float64 values.
+    """
+    run_bundle = event_model.compose_run()
+    descriptor_bundle = run_bundle.compose_descriptor(
+        name='primary',
+        data_keys={'waveform': {'source': 'waveform', 'dtype': 'array',
+                                'shape': [length]},
+                   'x': {'source': 'x', 'dtype': 'number', 'shape': []}})
+    return [descriptor_bundle.compose_event(
+                data={'waveform': numpy.random.random(length),
+                      'x': numpy.float64(i)},
+                timestamps={'waveform': time.time(), 'x': time.time()},
+                seq_num=i + 1)
+            for i in range(count)]
+
+
+def time_sanitized(events):
+    start = time.process_time()
+    for event in events:
+        bson.encode(event_model.sanitize_doc(event))
+    return time.process_time() - start
+
+
+def time_codec(events):
+    start = time.process_time()
+    for event in events:
+        bson.encode(event, codec_options=NUMPY_CODEC_OPTIONS)
+    return time.process_time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--events', type=int, default=10000,
+                        help="number of events to encode")
+    parser.add_argument('--length', type=int, default=1000,
+                        help="length of each event's waveform")
+    args = parser.parse_args()
+
+    events = make_events(args.events, args.length)
+    sanitized = time_sanitized(events)
+    codec = time_codec(events)
+    print(f"{'method':>10} {'CPU per event (us)':>20}")
+    print(f"{'sanitize':>10} {sanitized / args.events * 1e6:>20.1f}")
+    print(f"{'codec':>10} {codec / args.events * 1e6:>20.1f}")
+    print(f"speedup: {sanitized / codec:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -38,12 +38,13 @@ setup(
     cmdclass=versioneer.get_cmdclass(),
     long_description=readme,
     packages=['suitcase.mongo_normalized', 'suitcase.mongo_normalized.tests',
-              'suitcase.mongo_embedded',  'suitcase.mongo_embedded.tests'
+              'suitcase.mongo_embedded',  'suitcase.mongo_embedded.tests',
+              'suitcase.mongo_utils', 'suitcase.mongo_utils.tests',
               ],
     long_description_content_type='text/markdown',
     entry_points={
         'console_scripts': [
-            # 'some.module:some_function',
+            'suitcase-mongo-indexes = suitcase.mongo_utils.indexes:main',
             ],
         },
     include_package_data=True,
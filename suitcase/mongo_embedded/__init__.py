@@ -1,13 +1,24 @@
+import array
 import event_model
 from ._version import get_versions
 from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor
+import itertools
+import numpy
+import os
 from pymongo import UpdateOne
 import pymongo
-from threading import Event, Lock
+from threading import Condition, Event, Lock
 import time
 import queue
+import uuid
 import bson
+from bson.raw_bson import RawBSONDocument
+import tempfile
+from suitcase.mongo_utils import (
+    NUMPY_CODEC_OPTIONS, contains_numpy, ensure_indexes, get_database,
+    has_numpy_codec, with_numpy_codec)
+from .journal import Journal
 
 __version__ = get_versions()['version']
 del get_versions
@@ -32,6 +43,10 @@ class Serializer(event_model.DocumentRouter):
     name or signature common to suitcase packages because it can only write
     via pymongo, not to an arbitrary user-provided buffer.
 
+    A Serializer handles one run. To write many runs from a long-lived
+    process without starting new worker threads for each of them, use
+    ``SerializerFactory`` with ``event_model.RunRouter``.
+
     Examples
     --------
     >>> from bluesky import RunEngine
@@ -59,19 +74,28 @@ class Serializer(event_model.DocumentRouter):
 
     def __init__(self, db, num_threads=1, queue_size=100,
                  embedder_size=1000000, page_size=5000000,
-                 max_insert_time=5, **kwargs):
+                 max_insert_time=5, create_indexes=True, verify_indexes=False,
+                 writer_pool=None, memory_budget=None, backpressure='block',
+                 put_timeout=None, spill_dir=None, journal=None,
+                 max_retries=5, retry_backoff=0.5, page_encoding='list',
+                 uid_encoding='string', **kwargs):
 
         """
         Insert documents into MongoDB using an embedded data model.
 
         Parameters
         ----------
-        db: pymongo database
-        num_theads: int, optional
-            number of workers that read from the buffer and write to the
-            database. Must be 5 or less. Default is 1.
+        db: pymongo database or URI
+            MongoClients created for URIs are shared with other Serializers,
+            see ``suitcase.mongo_utils.get_client``.
+        num_threads: int, optional
+            number of event workers and of datum workers that read from the
+            buffer and write to the database. Each event stream (descriptor)
+            and each datum stream (resource) is assigned to one worker, which
+            has its own queue and embedder, so different streams are written
+            concurrently. Must be between 1 and 10. Default is 1.
         queue_size: int, optional
-            maximum size of the queue.
+            maximum size of each worker's queue.
         page_size: int, optional
             the document size for event_page and datum_page documents. The
             maximum event/datum_page size is embedder_size + page_size.
@@ -79,42 +103,128 @@ class Serializer(event_model.DocumentRouter):
             default is 5000000.
         embedder_size: int, optional
             maximum size of the embedder
-        max_insert_time: int, optional
-            maximum time that the workers will wait before doing a database
-            insert.
+        max_insert_time: float, optional
+            maximum time, in seconds, that a document waits in a worker's
+            embedder before it is written to the database. The measured
+            latencies are available from the ``flush_latency`` property.
+        create_indexes: bool, optional
+            If False, assume that the indexes already exist and do not create
+            them, e.g. because they were built ahead of time with
+            ``suitcase-mongo-indexes build``. Default is True.
+        verify_indexes: bool, optional
+            Indexes are created once per process for each database and
+            collection, later Serializers skip creating them. If this is set
+            to True, the first Serializer instead reads the existing indexes
+            with ``index_information()`` and only creates the missing ones.
+            Default is False.
+        writer_pool: WriterPool, optional
+            Workers shared with the Serializers of other runs. When it is
+            given, num_threads, queue_size, embedder_size, max_insert_time,
+            memory_budget, backpressure, put_timeout and spill_dir are taken
+            from the pool and the arguments are ignored. By default the
+            Serializer starts its own workers and stops them when the run is
+            finished.
+        memory_budget: int, optional
+            maximum number of bytes held by the queues and embedders
+            together. By default the queues are bounded by queue_size.
+        backpressure: {'block', 'raise', 'spill'}, optional
+            What to do with a document that does not fit in memory_budget:
+            block for at most put_timeout seconds, raise BackpressureError,
+            or spill it to local disk. Default is 'block'. See ``WriterPool``.
+        put_timeout: float, optional
+            maximum time, in seconds, that 'block' waits. By default it waits
+            indefinitely.
+        spill_dir: str, optional
+            directory of the spill files.
+        journal: Journal or str, optional
+            A journal, or the directory of a new journal, that each document
+            is appended to before the call that inserts it returns.
+            Documents rejected with BackpressureError are not appended. The
+            run's records are kept
+            until the run has been written, so that it can be written again
+            with ``suitcase.mongo_embedded.journal.replay`` after a crash.
+            See ``suitcase.mongo_embedded.journal.Journal``.
+        max_retries: int, optional
+            number of times that a bulk write of event or datum pages is
+            retried after a transient error, such as a lost connection or a
+            replica set election. Default is 5.
+        retry_backoff: float, optional
+            time, in seconds, before the first retry. It doubles with every
+            retry. Default is 0.5. The retries are counted by the ``retries``
+            property.
+        page_encoding: {'list', 'binary', 'compressed'}, optional
+            How the columns of event pages are stored. 'list' stores each
+            value as a BSON array element. 'binary' stores time, seq_num and
+            the data keys that the descriptor declares with a numeric dtype
+            as binary chunks of packed values, with their dtype and shape.
+            'compressed' also stores each contiguous run of seq_num as its
+            start and count, and time and timestamps as delta-encoded binary
+            chunks. Read them back with ``decode_event_page``. Default is
+            'list'.
+        uid_encoding: {'string', 'binary'}, optional
+            How the uid of events and the datum_id of datum are stored in
+            pages. 'binary' stores the ones that are canonical UUID strings
+            as 16-byte BSON UUIDs, which makes pages and their uid indexes
+            smaller. Read them back with ``decode_event_page`` and
+            ``decode_datum_page``, and look them up with ``uid_query``.
+            Default is 'string'.
         """
         self._frozen_lock = Lock()
 
-        # There is no performace improvment for more than 10 threads. Tests
-        # validate for upto 10 threads.
-        if num_threads > 10 or num_threads < 1:
-            raise ValueError("num_threads must be between 1 and 10"
-                             "inclusive.")
-
         if page_size < 1000:
             raise ValueError("page_size must be >= 1000")
+        if page_encoding not in ('list', 'binary', 'compressed'):
+            raise ValueError(f"Invalid page_encoding {page_encoding}, "
+                             "page_encoding must be one of 'list', "
+                             "'binary' or 'compressed'")
+        if uid_encoding not in ('string', 'binary'):
+            raise ValueError(f"Invalid uid_encoding {uid_encoding}, "
+                             "uid_encoding must be either 'string' or "
+                             "'binary'")
+
+        if writer_pool is None:
+            writer_pool = WriterPool(num_threads=num_threads,
+                                     queue_size=queue_size,
+                                     embedder_size=embedder_size,
+                                     max_insert_time=max_insert_time,
+                                     memory_budget=memory_budget,
+                                     backpressure=backpressure,
+                                     put_timeout=put_timeout,
+                                     spill_dir=spill_dir)
+            self._private_pool = True
+        else:
+            self._private_pool = False
+        self._pool = writer_pool
 
         # Maximum size of a document in mongo is 16MB. buffer_size + page_size
         # defines the biggest document that can be created.
-        if embedder_size + page_size > 15000000:
-            raise ValueError(f"embedder_size: {embedder_size} + page_size:"
-                             "{page_size} is greater then 15000000.")
+        if self._pool._EMBED_SIZE + page_size > 15000000:
+            if self._private_pool:
+                self._pool.close()
+            raise ValueError(f"embedder_size: {self._pool._EMBED_SIZE} + "
+                             f"page_size: {page_size} is greater then "
+                             "15000000.")
 
-        self._QUEUE_SIZE = queue_size
-        self._EMBED_SIZE = embedder_size
         self._PAGE_SIZE = page_size
-        self._MAX_INSERT = max_insert_time
-        self._QUEUE_TIMEOUT = 0.2
-        self._db = db
-        self._event_queue = queue.Queue(maxsize=self._QUEUE_SIZE)
-        self._datum_queue = queue.Queue(maxsize=self._QUEUE_SIZE)
-        self._event_embedder = Embedder('event', self._EMBED_SIZE)
-        self._datum_embedder = Embedder('datum', self._EMBED_SIZE)
+        if isinstance(journal, str):
+            journal = Journal(journal)
+            self._private_journal = True
+        else:
+            self._private_journal = False
+        self._journal = journal
+        if isinstance(db, str):
+            db = get_database(db)
+        # Encode numpy objects as pages are written, rather than sanitizing
+        # every document ahead of time.
+        self._db = with_numpy_codec(db)
+        self._numpy_codec = has_numpy_codec(self._db)
         self._kwargs = kwargs
+        self._verify_indexes = verify_indexes
         self._start_found = False
         self._run_uid = None
+        # The _id of the run's header document, once it has been created.
+        self._header_id = None
         self._frozen = False
-        self._count = Event()
         self._worker_error = None
         self._stop_doc = None
 
@@ -127,215 +237,262 @@ class Serializer(event_model.DocumentRouter):
         # that have been successfully inserted into the database.
         self._db_event_count = defaultdict(lambda: 0)
         self._db_datum_count = defaultdict(lambda: 0)
+        # The counts that were last written to the header.
+        self._header_counts = {}
 
-        # Start workers.
-        self._event_executor = ThreadPoolExecutor(max_workers=1)
-        self._datum_executor = ThreadPoolExecutor(max_workers=1)
-        self._count_executor = ThreadPoolExecutor(max_workers=1)
-        self._event_executor.submit(self._event_worker)
-        self._datum_executor.submit(self._datum_worker)
-        self._count_executor.submit(self._count_worker)
+        # The page that each stream is currently writing to, as a list of its
+        # _id and its size. Each stream is written by a single worker.
+        self._open_event_pages = {}
+        self._open_datum_pages = {}
+        # Guards the counters, which are updated by all of the workers.
+        self._count_lock = Lock()
+
+        # Flush times and latencies, per stream.
+        self._last_flush = {}
+        self._flush_latency = {}
+
+        self._max_retries = max_retries
+        self._retry_backoff = retry_backoff
+        self._retries = {'event': 0, 'datum': 0}
+
+        self._page_encoding = page_encoding
+        self._uid_encoding = uid_encoding
+        # The dtype and shape of the binary data columns of each descriptor.
+        self._column_dtypes = {}
+        # The update paths of the data keys of each descriptor.
+        self._key_paths = {}
 
-        self._create_indexes()
+        if create_indexes:
+            self._create_indexes()
+
+        self._pool.register(self)
 
     def _create_indexes(self):
         """
         Create indexes on the various collections.
-         If the index already exists, this has no effect.
-        """
-        self._db.header.create_index('resources.uid', unique=True, sparse=True)
-        self._db.header.create_index('resources.resource_id')  # legacy
-        self._db.header.create_index(
-            [('start.uid', pymongo.DESCENDING)], unique=True, sparse=True)
-        self._db.header.create_index(
-            [('start.time', pymongo.DESCENDING),
-             ('start.scan_id', pymongo.DESCENDING)],
-            unique=False, background=True)
-        self._db.header.create_index([("$**", "text")])
-        self._db.header.create_index('stop.run_start', unique=True, sparse=True)
-        self._db.header.create_index('stop.uid', unique=True, sparse=True)
-        self._db.header.create_index(
-            [('stop.time', pymongo.DESCENDING)], unique=False,
-            background=True, sparse=True)
-        self._db.header.create_index(
-            [('descriptors.uid', pymongo.DESCENDING)], unique=True, sparse=True)
-        self._db.header.create_index(
-            [('descriptors.run_start', pymongo.DESCENDING),
-             ('time', pymongo.DESCENDING)],
-            unique=False, background=True)
-        self._db.header.create_index(
-            [('descriptors.time', pymongo.DESCENDING)],
-            unique=False, background=True)
-        self._db.event.create_index(
-            [('uid', pymongo.DESCENDING)], unique=True, sparse=True)
-        self._db.event.create_index(
-            [('descriptor', pymongo.DESCENDING),
-             ('time.0', pymongo.ASCENDING)],
-            unique=False, background=True)
-        self._db.datum.create_index('datum_id', unique=True, sparse=True)
-        self._db.datum.create_index('resource')
+
+        If the index already exists, this has no effect. Index sets that this
+        process has already ensured are skipped without a round trip.
+        """
+        for collection, indexes in _indexes().items():
+            ensure_indexes(self._db.get_collection(collection), indexes,
+                           verify=self._verify_indexes)
 
     def __call__(self, name, doc):
-        # Before inserting into mongo, convert any numpy objects into built-in
-        # Python types compatible with pymongo.
-        sanitized_doc = event_model.sanitize_doc(doc)
-        if self._worker_error:
-            raise RuntimeError("Worker exception: ") from self._worker_error
+        """
+        Insert a document.
+
+        doc may be a ``bson.raw_bson.RawBSONDocument``, e.g. a document that
+        was received already encoded as BSON. It is decoded once, and is not
+        sanitized or sized again.
+        """
+        if isinstance(doc, RawBSONDocument):
+            return self._call_raw(name, doc)
+        if not contains_numpy(doc) or (self._numpy_codec
+                                       and name not in _PAGES):
+            # The collections encode numpy objects themselves. Pages are
+            # sliced as lists, so their numpy arrays are still converted.
+            sanitized_doc = doc
+        else:
+            # Before inserting into mongo, convert any numpy objects into
+            # built-in Python types compatible with pymongo.
+            sanitized_doc = event_model.sanitize_doc(doc)
+        self._raise_worker_error()
         if self._frozen:
             raise RuntimeError("Cannot insert documents into "
                                "frozen Serializer.")
 
         return super().__call__(name, sanitized_doc)
 
-    def _try_wrapper(f):
-        from functools import wraps
+    def _call_raw(self, name, raw_doc):
+        # BSON holds no numpy objects, and the size of the encoded document
+        # is the size that the embedder needs.
+        doc = bson.decode(raw_doc.raw)
+        self._raise_worker_error()
+        if self._frozen:
+            raise RuntimeError("Cannot insert documents into "
+                               "frozen Serializer.")
+        stream_key = _STREAM_KEYS.get(name)
+        if stream_key is None:
+            return super().__call__(name, doc)
+        doc_type = name.split('_')[0]
+        self._pool.put(doc_type, self, doc[stream_key], doc,
+                       page=name.endswith('_page'), size=len(raw_doc.raw))
+        self._journal_append(name, raw_doc)
+        return name, doc
+
+    def _raise_worker_error(self):
+        error = self._worker_error or self._pool._worker_error
+        if error:
+            raise RuntimeError("Worker exception: ") from error
+
+    def _write_pages(self, doc_type, pages, sizes, insert_times):
+        """
+        Writes pages to the database and updates the counters and the flush
+        statistics of their streams.
+        """
+        if doc_type == 'event':
+            self._bulkwrite_event(pages, sizes)
+            db_count, count_key = self._db_event_count, 'seq_num'
+        else:
+            self._bulkwrite_datum(pages, sizes)
+            db_count, count_key = self._db_datum_count, 'datum_id'
+        flush_time = time.monotonic()
+        with self._count_lock:
+            for stream_id, page in pages.items():
+                db_count['count_' + stream_id] += len(page[count_key])
+                self._last_flush[stream_id] = flush_time
+                self._flush_latency[stream_id] = (
+                    flush_time - insert_times[stream_id])
+
+    @property
+    def last_flush(self):
+        """
+        Maps each stream (descriptor or resource uid) to the time.monotonic()
+        value of its last write to the database.
+        """
+        with self._count_lock:
+            return dict(self._last_flush)
 
-        @wraps(f)
-        def inner(self):
-            try:
-                f(self)
-            except Exception as error:
-                self._worker_error = error
-                raise
-        return inner
-
-    @_try_wrapper
-    def _event_worker(self):
-        # Gets events from the queue, embedds them, and writes them to the
-        # database.
-        last_push = 0
-        event = None
-
-        # When a stop document is received 'False' is pushed on to the
-        # queue, this signals the worker to finish.
-        while event is not False:
-            last_push = time.monotonic()
-            do_push = False
-            try:
-                if event is None:
-                    event = self._event_queue.get(timeout=self._QUEUE_TIMEOUT)
-            except queue.Empty:
-                do_push = True
-            else:
-                # embedder.insert() returns None if the document is inserted,
-                # and returns the document, if embedder is full.
-                if event is not False:
-                    event = self._event_embedder.insert(event)
-            if (
-                    event is not None
-                    or event is False
-                    or do_push
-                    or time.monotonic() > (last_push + self._MAX_INSERT)):
-                if not self._event_embedder.empty():
-                    event_dump, dump_sizes = self._event_embedder.dump()
-                    self._bulkwrite_event(event_dump, dump_sizes)
-                    for descriptor, event_page in event_dump.items():
-                        self._db_event_count['count_' + descriptor] += len(
-                                event_page['seq_num'])
-                last_push = time.monotonic()
-                do_push = False
-
-    @_try_wrapper
-    def _datum_worker(self):
-        # Gets datum from the queue, embedds them, and writes them to the
-        # database.
-
-        last_push = 0
-        datum = None
-
-        # When a stop document is received 'False' is pushed on to the
-        # queue, this signals the worker to finish.
-        while datum is not False:
-            last_push = time.monotonic()
-            do_push = False
-            try:
-                if datum is None:
-                    datum = self._datum_queue.get(timeout=self._QUEUE_TIMEOUT)
-            except queue.Empty:
-                do_push = True
-            else:
-                # embedder.insert() returns None if the document is inserted,
-                # and returns the document, if embedder is full.
-                if datum is not False:
-                    datum = self._datum_embedder.insert(datum)
-            if (
-                    datum is not None
-                    or datum is False
-                    or do_push
-                    or time.monotonic() > (last_push + self._MAX_INSERT)):
-
-                if not self._datum_embedder.empty():
-                    datum_dump, dump_sizes = self._datum_embedder.dump()
-                    self._bulkwrite_datum(datum_dump, dump_sizes)
-                    for resource, datum_page in datum_dump.items():
-                        self._db_datum_count['count_' + resource] += len(
-                                datum_page['datum_id'])
-                last_push = time.monotonic()
-                do_push = False
-
-    @_try_wrapper
-    def _count_worker(self):
-        # Updates event_count and datum_count in the header document
+    @property
+    def flush_latency(self):
+        """
+        Maps each stream (descriptor or resource uid) to the time, in seconds,
+        that the oldest document of its last write waited before reaching the
+        database.
+        """
+        with self._count_lock:
+            return dict(self._flush_latency)
+
+    @property
+    def retries(self):
+        """
+        The number of bulk writes of event pages and of datum pages that were
+        retried after a transient error, as a dict.
+        """
+        with self._count_lock:
+            return dict(self._retries)
 
-        last_event_count = defaultdict(lambda: 0)
-        last_datum_count = defaultdict(lambda: 0)
+    @property
+    def fill_level(self):
+        """
+        The current fill level of the Serializer's queues and embedders, see
+        ``WriterPool.fill_level``.
+        """
+        return self._pool.fill_level
 
-        while not self._frozen:
-            self._count.wait(timeout=5)
-            # Only updates the header if the count has changed.
-            if (
-                    (sum(self._db_event_count.values()) >
-                     sum(last_event_count.values()))
-                    or (sum(self._db_datum_count.values()) >
-                        sum(last_datum_count.values()))
-               ):
-                self._db.header.update_one(
-                    {'run_id': self._run_uid},
-                    {'$set': {**dict(self._db_event_count),
-                              **dict(self._db_datum_count)}})
-
-                last_event_count = self._db_event_count
-                last_datum_count = self._db_datum_count
+    def _update_counts(self):
+        """
+        Writes the per-stream counts to the header, if they have changed.
+
+        Called periodically by the pool's count worker, and once more when
+        the run is finalized.
+        """
+        # The counts are updated by all of the event and datum workers.
+        with self._count_lock:
+            counts = {**self._db_event_count, **self._db_datum_count}
+            if counts == self._header_counts or self._run_uid is None:
+                return
+            self._header_counts = counts
+        self._db.header.update_one(self._header_filter(), {'$set': counts})
+
+    def _journal_append(self, name, doc):
+        if self._journal is not None:
+            self._journal.append(self._run_uid, name, doc)
+
+    def _resume(self, header):
+        """
+        Continues a run whose header is already in the database, see
+        ``suitcase.mongo_embedded.journal.replay``.
+        """
+        self._start_found = True
+        self._run_uid = header['run_id']
+        self._header_id = header['_id']
+
+    def _resume_stream(self, doc_type, stream_id):
+        """
+        Continues a stream from its pages in the database.
+
+        The stream's counts continue from the pages, and its next write goes
+        to the page it was last writing to. Returns the uids, or datum_ids,
+        of the stream that are already in the database.
+        """
+        if doc_type == 'event':
+            collection, stream_key, uid_key = self._db.event, 'descriptor', 'uid'
+            count, db_count = self._event_count, self._db_event_count
+            open_pages = self._open_event_pages
+        else:
+            collection, stream_key, uid_key = (self._db.datum, 'resource',
+                                               'datum_id')
+            count, db_count = self._datum_count, self._db_datum_count
+            open_pages = self._open_datum_pages
+        written = set()
+        last_page = None
+        for page in collection.find({stream_key: stream_id},
+                                    {uid_key: True, 'size': True,
+                                     'last_index': True}):
+            written.update(map(_decode_uid, page[uid_key]))
+            if last_page is None or page['last_index'] > last_page['last_index']:
+                last_page = page
+        count[stream_id] = len(written)
+        db_count['count_' + stream_id] = len(written)
+        if last_page is not None:
+            open_pages[stream_id] = [last_page['_id'], last_page['size']]
+        return written
 
     def start(self, doc):
         self._check_start(doc)
         self._run_uid = doc['uid']
+        self._journal_append('start', doc)
         self._insert_header('start', doc)
         self._insert_header('event_count', doc)
         self._insert_header('datum_count', doc)
         return doc
 
     def stop(self, doc):
+        self._journal_append('stop', doc)
         self._stop_doc = doc
         self.close()
         return doc
 
     def descriptor(self, doc):
+        self._journal_append('descriptor', doc)
+        # The stream's columns and update paths are laid out once, rather
+        # than discovered from each of its events.
+        self._key_paths[doc['uid']] = _key_paths(doc['data_keys'])
+        self._pool.describe(doc)
+        if self._page_encoding != 'list':
+            self._column_dtypes[doc['uid']] = _column_dtypes(doc['data_keys'])
         self._insert_header('descriptors', doc)
         return doc
 
     def resource(self, doc):
+        self._journal_append('resource', doc)
         self._insert_header('resources', doc)
         return doc
 
     def event(self, doc):
-        self._event_queue.put(doc)
+        # Only documents that the pool accepts are journaled; put raises
+        # BackpressureError for the others.
+        self._pool.put('event', self, doc['descriptor'], doc)
+        self._journal_append('event', doc)
         return doc
 
     def datum(self, doc):
-        self._datum_queue.put(doc)
+        self._pool.put('datum', self, doc['resource'], doc)
+        self._journal_append('datum', doc)
         return doc
 
     def event_page(self, doc):
-        doc_size = len(bson.BSON.encode(doc))
-        self._bulkwrite_event({doc['descriptor']: doc},
-                              {doc['descriptor']: doc_size})
+        # Pages go through the same queue as the events of their stream, so
+        # they are written in order and off of the caller's thread.
+        self._pool.put('event', self, doc['descriptor'], doc, page=True)
+        self._journal_append('event_page', doc)
         return doc
 
     def datum_page(self, doc):
-        doc_size = len(bson.BSON.encode(doc))
-        self._bulkwrite_datum({doc['resource']: doc},
-                              {doc['resource']: doc_size})
+        self._pool.put('datum', self, doc['resource'], doc, page=True)
+        self._journal_append('datum_page', doc)
         return doc
 
     def close(self):
@@ -356,46 +513,63 @@ class Serializer(event_model.DocumentRouter):
             if self._frozen:
                 return
             self._frozen = True
-        self._event_queue.put(False)
-        self._datum_queue.put(False)
 
-        # Interupt the count worker sleep
-        self._count.set()
-
-        self._count_executor.shutdown(wait=True)
-        self._event_executor.shutdown(wait=True)
-        self._datum_executor.shutdown(wait=True)
+        # Wait for the workers to write everything of this run, then release
+        # its streams. Private workers are stopped.
+        try:
+            if self._private_pool:
+                self._pool.close()
+            else:
+                self._pool.flush()
+        finally:
+            self._pool.unregister(self)
 
+        self._update_counts()
         self._set_header('event_count', sum(self._event_count.values()))
         self._set_header('datum_count', sum(self._datum_count.values()))
 
-        if self._worker_error:
-            raise RuntimeError("Worker exception: ") from self._worker_error
+        try:
+            self._raise_worker_error()
 
-        # Raise exception if buffers are not empty.
-        assert self._event_queue.empty()
-        assert self._datum_queue.empty()
-        assert self._event_embedder.empty()
-        assert self._datum_embedder.empty()
-
-        # Insert the stop doc.
-        self._insert_header('stop', self._stop_doc)
+            # Insert the stop doc.
+            self._insert_header('stop', self._stop_doc)
+            # The run is in the database, its journal records can go.
+            if self._journal is not None:
+                self._journal.finish(self._run_uid)
+        finally:
+            if self._private_journal:
+                self._journal.close()
 
     def _insert_header(self, name,  doc):
         """
         Inserts header document into the run's header document.
         """
-        self._db.header.update_one({'run_id': self._run_uid},
-                                   {'$push': {name: doc}},
-                                   upsert=True)
+        result = self._db.header.update_one(self._header_filter(),
+                                            {'$push': {name: doc}},
+                                            upsert=True)
+        if self._header_id is None:
+            if result.upserted_id is not None:
+                self._header_id = result.upserted_id
+            else:
+                # The header already existed.
+                self._header_id = self._db.header.find_one(
+                    {'run_id': self._run_uid}, {'_id': True})['_id']
 
     def _set_header(self, name,  doc):
         """
         Inserts header document into the run's header document.
         """
-        self._db.header.update_one({'run_id': self._run_uid},
+        self._db.header.update_one(self._header_filter(),
                                    {'$set': {name: doc}})
 
+    def _header_filter(self):
+        """
+        Returns the filter that selects the run's header document.
+        """
+        if self._header_id is None:
+            return {'run_id': self._run_uid}
+        return {'_id': self._header_id}
+
     def _bulkwrite_datum(self, datum_buffer, dump_sizes):
         """
         Bulk writes datum_pages to Mongo datum collection.
@@ -403,7 +577,7 @@ class Serializer(event_model.DocumentRouter):
         operations = [self._updateone_datumpage(resource, datum_page,
                                                 dump_sizes[resource])
                       for resource, datum_page in datum_buffer.items()]
-        self._db.datum.bulk_write(operations, ordered=False)
+        self._bulk_write('datum', self._db.datum, operations)
 
     def _bulkwrite_event(self, event_buffer, dump_sizes):
         """
@@ -412,38 +586,80 @@ class Serializer(event_model.DocumentRouter):
         operations = [self._updateone_eventpage(descriptor, event_page,
                                                 dump_sizes[descriptor])
                       for descriptor, event_page in event_buffer.items()]
-        self._db.event.bulk_write(operations, ordered=False)
+        self._bulk_write('event', self._db.event, operations)
+
+    def _bulk_write(self, doc_type, collection, operations):
+        """
+        Bulk writes page updates, and retries them after transient errors.
+
+        A retry writes the same operations again. An update only matches its
+        page while the page's last_index is lower than the update's, so an
+        update that reached the database before the error is not applied
+        twice. It tries to insert a new page with the same _id instead, and
+        the duplicate key error that this raises is ignored once the page is
+        found to hold the update.
+        """
+        for attempt in itertools.count():
+            try:
+                collection.bulk_write(operations, ordered=False)
+                return
+            except pymongo.errors.BulkWriteError as error:
+                write_errors = error.details['writeErrors']
+                if not (attempt and write_errors and all(
+                        _is_applied(collection, operations[write_error['index']],
+                                    write_error)
+                        for write_error in write_errors)):
+                    raise
+                return
+            except pymongo.errors.PyMongoError as error:
+                if attempt >= self._max_retries or not _is_transient(error):
+                    raise
+            with self._count_lock:
+                self._retries[doc_type] += 1
+            time.sleep(self._retry_backoff * 2 ** attempt)
 
     def _updateone_eventpage(self, descriptor_id, event_page, size):
         """
         Creates the UpdateOne command that gets used with bulk_write.
         """
         event_size = size
-
-        data_string = {'data.' + key: {'$each': value_array}
-                       for key, value_array in event_page['data'].items()}
-
-        timestamp_string = {'timestamps.' + key: {'$each': value_array}
-                            for key, value_array
-                            in event_page['timestamps'].items()}
-
-        filled_string = {'filled.' + key: {'$each': value_array}
-                         for key, value_array in event_page['filled'].items()}
-
-        update_string = {**data_string, **timestamp_string, **filled_string}
+        page_fields = {'descriptor': descriptor_id}
+        if self._page_encoding != 'list':
+            event_page = _encode_event_page(
+                event_page, self._column_dtypes.get(descriptor_id, {}),
+                compress=self._page_encoding == 'compressed')
+            page_fields['encoding'] = self._page_encoding
+        if self._uid_encoding == 'binary':
+            event_page = {**event_page, 'uid': _encode_uids(event_page['uid'])}
+        if self._page_encoding != 'list' or self._uid_encoding == 'binary':
+            # The encoded page is smaller than the documents it was made of.
+            event_size = _bson_size(event_page)
+
+        key_paths = self._key_paths.get(descriptor_id, {})
+        update_string = {}
+        for frame in ('data', 'timestamps', 'filled'):
+            paths = key_paths.get(frame, {})
+            for key, value_array in event_page[frame].items():
+                path = paths.get(key) or f'{frame}.{key}'
+                update_string[path] = {'$each': value_array}
 
         count = len(event_page['seq_num'])
-        self._event_count[descriptor_id] += count
+        with self._count_lock:
+            self._event_count[descriptor_id] += count
+            last_index = self._event_count[descriptor_id]
 
+        page_id = self._open_page(self._open_event_pages, descriptor_id,
+                                  event_size)
         return UpdateOne(
-            {'descriptor': descriptor_id, 'size': {'$lt': self._PAGE_SIZE}},
-            {'$push': {'uid': {'$each': event_page['uid']},
+            {'_id': page_id, 'last_index': {'$lt': last_index - 1}},
+            {'$setOnInsert': page_fields,
+             '$push': {'uid': {'$each': event_page['uid']},
                        'time': {'$each': event_page['time']},
                        'seq_num': {'$each': event_page['seq_num']},
                        **update_string},
              '$inc': {'size': event_size},
-             '$min': {'first_index': self._event_count[descriptor_id] - count},
-             '$max': {'last_index': self._event_count[descriptor_id] - 1}},
+             '$min': {'first_index': last_index - count},
+             '$max': {'last_index': last_index - 1}},
             upsert=True)
 
     def _updateone_datumpage(self, resource_id, datum_page, size):
@@ -451,23 +667,45 @@ class Serializer(event_model.DocumentRouter):
         Creates the UpdateOne command that gets used with bulk_write.
         """
         datum_size = size
+        if self._uid_encoding == 'binary':
+            datum_page = {**datum_page,
+                          'datum_id': _encode_uids(datum_page['datum_id'])}
+            datum_size = _bson_size(datum_page)
 
         kwargs_string = {'datum_kwargs.' + key: {'$each': value_array}
                          for key, value_array
                          in datum_page['datum_kwargs'].items()}
 
         count = len(datum_page['datum_id'])
-        self._datum_count[resource_id] += count
+        with self._count_lock:
+            self._datum_count[resource_id] += count
+            last_index = self._datum_count[resource_id]
 
+        page_id = self._open_page(self._open_datum_pages, resource_id,
+                                  datum_size)
         return UpdateOne(
-            {'resource': resource_id, 'size': {'$lt': self._PAGE_SIZE}},
-            {'$push': {'datum_id': {'$each': datum_page['datum_id']},
+            {'_id': page_id, 'last_index': {'$lt': last_index - 1}},
+            {'$setOnInsert': {'resource': resource_id},
+             '$push': {'datum_id': {'$each': datum_page['datum_id']},
                        **kwargs_string},
              '$inc': {'size': datum_size},
-             '$min': {'first_index': self._datum_count[resource_id] - count},
-             '$max': {'last_index': self._datum_count[resource_id] - 1}},
+             '$min': {'first_index': last_index - count},
+             '$max': {'last_index': last_index - 1}},
             upsert=True)
 
+    def _open_page(self, open_pages, stream_id, size):
+        """
+        Returns the _id of the page that the next write to the stream goes to.
+
+        A page accepts writes until its size reaches page_size, then the
+        stream rolls over to a new page with a new _id.
+        """
+        page = open_pages.get(stream_id)
+        if page is None or page[1] >= self._PAGE_SIZE:
+            page = open_pages[stream_id] = [bson.ObjectId(), 0]
+        page[1] += size
+        return page[0]
+
     def _check_start(self, doc):
         if self._start_found:
             raise RuntimeError(
@@ -478,6 +716,974 @@ class Serializer(event_model.DocumentRouter):
             self._start_found = True
 
 
+class BackpressureError(RuntimeError):
+    """
+    Raised when a document does not fit in the memory budget of a WriterPool.
+    """
+    pass
+
+
+class WriterPool():
+    """
+    Worker threads that embed events and datum and write them to MongoDB.
+
+    A WriterPool can be shared by the Serializers of many runs, so that a
+    long-lived process does not start and stop threads for every run, see
+    ``SerializerFactory``. Each event stream (descriptor) and each datum
+    stream (resource) is assigned to one event worker or one datum worker,
+    round-robin in the order that the streams are first seen. Each worker
+    has its own queue and embedder, which hold the documents of all of the
+    runs that its streams belong to.
+
+    Parameters
+    ----------
+    num_threads: int, optional
+        number of event workers and of datum workers. Must be between 1 and
+        10. Default is 1.
+    queue_size: int, optional
+        maximum number of documents in each worker's queue. Ignored if
+        memory_budget is given.
+    embedder_size: int, optional
+        maximum size of each worker's embedder
+    max_insert_time: float, optional
+        maximum time, in seconds, that a document waits in a worker's
+        embedder before it is written to the database.
+    memory_budget: int, optional
+        maximum number of bytes held by all of the queues and embedders
+        together, as measured by the BSON size of the documents. A document
+        is counted from the moment it is queued until it has been written.
+        By default the queues are only bounded by queue_size.
+    backpressure: {'block', 'raise', 'spill'}, optional
+        What to do with a document that does not fit in the memory budget:
+        wait for the workers to make room, for at most put_timeout seconds,
+        raise BackpressureError, or append it to a spill file on local disk,
+        from which its worker reads it back in order. Default is 'block'.
+    put_timeout: float, optional
+        maximum time, in seconds, that 'block' waits before raising
+        BackpressureError. By default it waits indefinitely.
+    spill_dir: str, optional
+        directory of the spill files. Defaults to the system's temporary
+        directory.
+    """
+
+    def __init__(self, num_threads=1, queue_size=100, embedder_size=1000000,
+                 max_insert_time=5, memory_budget=None, backpressure='block',
+                 put_timeout=None, spill_dir=None):
+        # There is no performace improvment for more than 10 threads. Tests
+        # validate for upto 10 threads.
+        if num_threads > 10 or num_threads < 1:
+            raise ValueError("num_threads must be between 1 and 10"
+                             "inclusive.")
+        if backpressure not in _BACKPRESSURE_POLICIES:
+            raise ValueError(f"Invalid backpressure {backpressure}, "
+                             "backpressure must be one of "
+                             f"{_BACKPRESSURE_POLICIES}")
+
+        self._QUEUE_SIZE = queue_size
+        self._EMBED_SIZE = embedder_size
+        self._MAX_INSERT = max_insert_time
+        self._QUEUE_TIMEOUT = 0.2
+        self._NUM_THREADS = num_threads
+        self._backpressure = backpressure
+        self._put_timeout = put_timeout
+        if memory_budget is None:
+            self._budget = None
+        else:
+            self._budget = _MemoryBudget(memory_budget)
+            # The queues are bounded by the budget instead.
+            queue_size = 0
+        self._queues = {
+            doc_type: [queue.Queue(maxsize=queue_size)
+                       for _ in range(num_threads)]
+            for doc_type in ('event', 'datum')}
+        self._embedders = {
+            doc_type: [Embedder(doc_type, embedder_size)
+                       for _ in range(num_threads)]
+            for doc_type in ('event', 'datum')}
+        if self._budget is not None and backpressure == 'spill':
+            self._spills = {
+                doc_type: [_SpillFile(spill_dir) for _ in range(num_threads)]
+                for doc_type in ('event', 'datum')}
+        else:
+            self._spills = None
+        # Maps each stream to the index of its worker, to the Serializer of
+        # its run, and to the function that sizes its documents. Streams are
+        # released when their run is finalized.
+        self._partitions = {'event': {}, 'datum': {}}
+        self._counters = {'event': itertools.count(),
+                          'datum': itertools.count()}
+        self._owners = {}
+        self._size_funcs = {}
+        self._serializers = set()
+        self._lock = Lock()
+        self._closed = False
+        self._count = Event()
+        # Set if a worker dies, which only happens on an unexpected error.
+        # Errors that writing a run's documents raise are reported to the
+        # run's Serializer and the worker carries on.
+        self._worker_error = None
+
+        # Start workers.
+        self._event_executor = ThreadPoolExecutor(max_workers=num_threads)
+        self._datum_executor = ThreadPoolExecutor(max_workers=num_threads)
+        self._count_executor = ThreadPoolExecutor(max_workers=1)
+        for index in range(num_threads):
+            self._event_executor.submit(self._worker, 'event', index)
+            self._datum_executor.submit(self._worker, 'datum', index)
+        self._count_executor.submit(self._count_worker)
+
+    @property
+    def fill_level(self):
+        """
+        Returns the current fill level of the pool, as a dict.
+
+        'used' is the number of bytes of the memory budget that are held by
+        queued and embedded documents, and 'budget' is the memory budget,
+        both None if there is no budget. 'spilled' is the number of bytes
+        waiting in spill files, and 'queued' the number of items in the
+        queues.
+        """
+        queued = sum(worker_queue.qsize()
+                     for worker_queues in self._queues.values()
+                     for worker_queue in worker_queues)
+        spilled = 0
+        if self._spills is not None:
+            spilled = sum(spill.unread for spills in self._spills.values()
+                          for spill in spills)
+        if self._budget is None:
+            return {'used': None, 'budget': None, 'spilled': spilled,
+                    'queued': queued}
+        return {'used': self._budget.used, 'budget': self._budget.limit,
+                'spilled': spilled, 'queued': queued}
+
+    def register(self, serializer):
+        """
+        Adds a Serializer, whose header counts the count worker keeps up to
+        date.
+        """
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Cannot register a Serializer with a "
+                                   "closed WriterPool.")
+            self._serializers.add(serializer)
+
+    def describe(self, descriptor):
+        """
+        Lays out the columns of an event stream from its descriptor, in the
+        embedder of every event worker, see ``Embedder.describe``.
+        """
+        for embedder in self._embedders['event']:
+            embedder.describe(descriptor)
+
+    def unregister(self, serializer):
+        """
+        Removes a finalized Serializer and releases its streams.
+        """
+        with self._lock:
+            self._serializers.discard(serializer)
+            for stream_id in serializer._key_paths:
+                for embedder in self._embedders['event']:
+                    embedder.forget(stream_id)
+            for stream_id in [stream_id for stream_id, owner
+                              in self._owners.items() if owner is serializer]:
+                del self._owners[stream_id]
+                self._size_funcs.pop(stream_id, None)
+                self._partitions['event'].pop(stream_id, None)
+                self._partitions['datum'].pop(stream_id, None)
+
+    def put(self, doc_type, serializer, stream_id, doc, page=False,
+            size=None):
+        """
+        Puts a document, or a page, on the queue of the stream's worker.
+
+        The size of the document is computed, unless it is given.
+
+        Raises BackpressureError if the document does not fit in the memory
+        budget and the backpressure policy is 'raise', or 'block' and
+        put_timeout has passed.
+        """
+        index = self._partitions[doc_type].get(stream_id)
+        if index is None:
+            with self._lock:
+                index = self._partitions[doc_type][stream_id] = (
+                    next(self._counters[doc_type]) % self._NUM_THREADS)
+                self._owners[stream_id] = serializer
+        work_queue = self._queues[doc_type][index]
+
+        if self._budget is None:
+            # The embedder sizes the documents.
+            work_queue.put(_Page(stream_id, doc, size) if page
+                           else (doc, size))
+            return
+
+        if size is None and page:
+            size = _encoded_size(doc)
+        elif size is None:
+            size_func = self._size_funcs.get(stream_id)
+            if size_func is None:
+                size_func = self._size_funcs[stream_id] = _size_function(doc)
+            size = size_func(doc)
+        item = _Page(stream_id, doc, size) if page else (doc, size)
+
+        if self._budget.try_acquire(size):
+            work_queue.put(item)
+        elif self._backpressure == 'spill':
+            work_queue.put(self._spills[doc_type][index].append(item))
+        elif (self._backpressure == 'raise'
+              or not self._budget.acquire(size, self._put_timeout,
+                                          self._raise_worker_error)):
+            raise BackpressureError(
+                f"A document of {size} bytes does not fit in the memory "
+                f"budget, {self._budget.used} of {self._budget.limit} bytes "
+                "are in use.")
+        else:
+            work_queue.put(item)
+
+    def _raise_worker_error(self):
+        if self._worker_error:
+            raise RuntimeError("Worker exception: ") from self._worker_error
+
+    def _release(self, size):
+        # Returns the bytes of written, or rejected, documents to the budget.
+        if self._budget is not None and size:
+            self._budget.release(size)
+
+    def flush(self):
+        """
+        Waits until every document queued so far has been written.
+        """
+        markers = []
+        for worker_queues in self._queues.values():
+            for worker_queue in worker_queues:
+                marker = _Flush()
+                worker_queue.put(marker)
+                markers.append(marker)
+        for marker in markers:
+            while not marker.done.wait(timeout=self._QUEUE_TIMEOUT):
+                self._raise_worker_error()
+
+    def close(self):
+        """
+        Writes every queued document and stops the workers.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        # 'False' signals the workers to finish.
+        for worker_queues in self._queues.values():
+            for worker_queue in worker_queues:
+                worker_queue.put(False)
+
+        # Interupt the count worker sleep
+        self._count.set()
+
+        self._count_executor.shutdown(wait=True)
+        self._event_executor.shutdown(wait=True)
+        self._datum_executor.shutdown(wait=True)
+
+        if self._spills is not None:
+            for spills in self._spills.values():
+                for spill in spills:
+                    spill.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_details):
+        self.close()
+
+    def _worker(self, doc_type, index):
+        # Gets documents from the worker's queue, embedds them, and writes
+        # them to the database.
+        try:
+            self._work(doc_type, self._queues[doc_type][index],
+                       self._embedders[doc_type][index])
+        except Exception as error:
+            self._worker_error = error
+            raise
+
+    def _work(self, doc_type, work_queue, embedder):
+        item = None
+
+        # When the pool is closed 'False' is pushed on to the queue, this
+        # signals the worker to finish.
+        while item is not False:
+            do_push = False
+            try:
+                if item is None:
+                    item = work_queue.get(timeout=self._QUEUE_TIMEOUT)
+            except queue.Empty:
+                do_push = True
+            else:
+                if type(item) is _Spilled:
+                    item = item.spill.read(item)
+                    # Spilled documents are counted once they are back in
+                    # memory.
+                    self._budget.force(_item_size(item))
+                if type(item) is _Page:
+                    # Write everything embedded before the page first, so
+                    # that the stream stays in order.
+                    self._flush_embedder(doc_type, embedder)
+                    self._write_page(doc_type, item)
+                    item = None
+                    continue
+                if type(item) is _Flush:
+                    self._flush_embedder(doc_type, embedder)
+                    item.done.set()
+                    item = None
+                    continue
+                # embedder.insert() returns None if the document is inserted,
+                # and returns the document, if embedder is full.
+                if item is not False:
+                    doc, size = item
+                    try:
+                        if embedder.insert(doc, size) is None:
+                            item = None
+                    except Exception as error:
+                        self._owner(doc[embedder._stream_id_key]
+                                    )._worker_error = error
+                        self._release(size)
+                        item = None
+            # Push when the embedder is full, the pool is closed, the queue
+            # is idle, or the oldest embedded document has waited too long.
+            if (
+                    item is not None
+                    or do_push
+                    or embedder.age() >= self._MAX_INSERT):
+                self._flush_embedder(doc_type, embedder)
+
+    def _owner(self, stream_id):
+        with self._lock:
+            return self._owners[stream_id]
+
+    def _flush_embedder(self, doc_type, embedder):
+        """
+        Writes the contents of an embedder to the database.
+
+        The embedder can hold the streams of several runs, each run's pages
+        are written by its own Serializer.
+        """
+        if embedder.empty():
+            return
+        insert_times = embedder.insert_times()
+        embedder_dump, dump_sizes = embedder.dump()
+        runs = defaultdict(list)
+        for stream_id in embedder_dump:
+            runs[self._owner(stream_id)].append(stream_id)
+        for serializer, stream_ids in runs.items():
+            self._write_run_pages(
+                serializer, doc_type,
+                {stream_id: embedder_dump[stream_id]
+                 for stream_id in stream_ids},
+                {stream_id: dump_sizes[stream_id] for stream_id in stream_ids},
+                {stream_id: insert_times[stream_id]
+                 for stream_id in stream_ids})
+        self._release(sum(dump_sizes.values()))
+
+    def _write_page(self, doc_type, page):
+        """
+        Writes a queued page to the database.
+
+        Pages that are larger than the embedder are split, so that no write
+        can grow a page in the database by more than embedder_size.
+        """
+        serializer = self._owner(page.stream_id)
+        for chunk, chunk_size in _split_page(page.doc, self._EMBED_SIZE):
+            self._write_run_pages(serializer, doc_type,
+                                  {page.stream_id: chunk},
+                                  {page.stream_id: chunk_size},
+                                  {page.stream_id: page.enqueue_time})
+        self._release(page.size)
+
+    def _write_run_pages(self, serializer, doc_type, pages, sizes,
+                         insert_times):
+        # After an error, the rest of the run's documents are dropped. The
+        # error is raised by the run's Serializer.
+        if serializer._worker_error:
+            return
+        try:
+            serializer._write_pages(doc_type, pages, sizes, insert_times)
+        except Exception as error:
+            serializer._worker_error = error
+
+    def _count_worker(self):
+        # Updates the per-stream counts in the header documents.
+        try:
+            while not self._closed:
+                self._count.wait(timeout=5)
+                with self._lock:
+                    serializers = list(self._serializers)
+                for serializer in serializers:
+                    try:
+                        serializer._update_counts()
+                    except Exception as error:
+                        serializer._worker_error = error
+        except Exception as error:
+            self._worker_error = error
+            raise
+
+
+_BACKPRESSURE_POLICIES = ('block', 'raise', 'spill')
+
+
+class _MemoryBudget():
+    """
+    Counts the bytes that the queues and embedders of a WriterPool hold.
+
+    A document larger than the whole budget is let in when the budget is
+    empty, so that it cannot wait forever.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._condition = Condition()
+
+    def _fits(self, size):
+        return not self.used or self.used + size <= self.limit
+
+    def try_acquire(self, size):
+        with self._condition:
+            if not self._fits(size):
+                return False
+            self.used += size
+            return True
+
+    def acquire(self, size, timeout, check):
+        """
+        Waits for room, for at most timeout seconds. check is called while
+        waiting, to stop waiting on workers that have died.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while not self._fits(size):
+                check()
+                if deadline is None:
+                    wait = 0.2
+                else:
+                    wait = min(deadline - time.monotonic(), 0.2)
+                    if wait <= 0:
+                        return False
+                self._condition.wait(wait)
+            self.used += size
+            return True
+
+    def force(self, size):
+        with self._condition:
+            self.used += size
+
+    def release(self, size):
+        with self._condition:
+            self.used -= size
+            self._condition.notify_all()
+
+
+class _Spilled():
+    """
+    Stands in a worker's queue for a document that was spilled to disk.
+    """
+
+    __slots__ = ('spill', 'offset', 'length', 'size', 'stream_id',
+                 'enqueue_time')
+
+    def __init__(self, spill, offset, length, size, stream_id, enqueue_time):
+        self.spill = spill
+        self.offset = offset
+        self.length = length
+        self.size = size
+        # Only set for pages.
+        self.stream_id = stream_id
+        self.enqueue_time = enqueue_time
+
+
+class _SpillFile():
+    """
+    An append-only file of BSON documents that a worker's queue spills to.
+
+    The file is emptied whenever everything in it has been read back.
+    """
+
+    def __init__(self, spill_dir=None):
+        self._file = tempfile.TemporaryFile(dir=spill_dir)
+        self._lock = Lock()
+        self._pending = 0
+        self.size = 0
+        # The bytes that have been spilled and not read back yet.
+        self.unread = 0
+
+    def append(self, item):
+        if type(item) is _Page:
+            doc, size = item.doc, item.size
+            stream_id, enqueue_time = item.stream_id, item.enqueue_time
+        else:
+            (doc, size), stream_id, enqueue_time = item, None, None
+        data = bson.encode(doc, codec_options=NUMPY_CODEC_OPTIONS)
+        with self._lock:
+            offset = self.size
+            self._file.seek(offset)
+            self._file.write(data)
+            self._pending += 1
+            self.size += len(data)
+            self.unread += len(data)
+        return _Spilled(self, offset, len(data), size, stream_id,
+                        enqueue_time)
+
+    def read(self, spilled):
+        with self._lock:
+            self._file.flush()
+            data = os.pread(self._file.fileno(), spilled.length,
+                            spilled.offset)
+            self._pending -= 1
+            self.unread -= spilled.length
+            if not self._pending:
+                self._file.truncate(0)
+                self.size = 0
+        doc = bson.decode(data)
+        if spilled.stream_id is None:
+            return doc, spilled.size
+        page = _Page(spilled.stream_id, doc, spilled.size)
+        page.enqueue_time = spilled.enqueue_time
+        return page
+
+    def close(self):
+        self._file.close()
+
+
+def _item_size(item):
+    if type(item) is _Page:
+        return item.size
+    return item[1]
+
+
+class SerializerFactory():
+    """
+    Creates an embedded Serializer for each run, for ``event_model.RunRouter``.
+
+    Every run gets its own Serializer, which keeps the run's header, pages
+    and counts, but all of the Serializers share one WriterPool, one
+    database, and one pass over the indexes. This suits long-lived processes
+    that write many runs.
+
+    Parameters
+    ----------
+    db: pymongo database or URI
+    num_threads: int, optional
+        number of event workers and of datum workers, see ``WriterPool``.
+    queue_size: int, optional
+        maximum size of each worker's queue.
+    embedder_size: int, optional
+        maximum size of each worker's embedder
+    max_insert_time: float, optional
+        maximum time, in seconds, that a document waits in a worker's
+        embedder before it is written to the database.
+    memory_budget, backpressure, put_timeout, spill_dir: optional
+        Bound the memory that the workers' queues and embedders hold, see
+        ``WriterPool``.
+    journal: Journal or str, optional
+        A journal, or the directory of a new journal, shared by all of the
+        runs. See ``suitcase.mongo_embedded.journal.Journal``.
+    **kwargs:
+        Passed to each Serializer, e.g. page_size.
+
+    Examples
+    --------
+    >>> from bluesky import RunEngine
+    >>> from event_model import RunRouter
+    >>> from suitcase.mongo_embedded import SerializerFactory
+
+    >>> factory = SerializerFactory('mongodb://localhost:27017/db')
+    >>> RE = RunEngine({})
+    >>> RE.subscribe(RunRouter([factory]))
+    >>> ...
+    >>> factory.close()
+    """
+
+    def __init__(self, db, num_threads=1, queue_size=100,
+                 embedder_size=1000000, max_insert_time=5,
+                 memory_budget=None, backpressure='block', put_timeout=None,
+                 spill_dir=None, journal=None, **kwargs):
+        if isinstance(db, str):
+            db = get_database(db)
+        self._db = db
+        if isinstance(journal, str):
+            journal = Journal(journal)
+            self._private_journal = True
+        else:
+            self._private_journal = False
+        self._journal = journal
+        self._kwargs = kwargs
+        self._pool = WriterPool(num_threads=num_threads,
+                                queue_size=queue_size,
+                                embedder_size=embedder_size,
+                                max_insert_time=max_insert_time,
+                                memory_budget=memory_budget,
+                                backpressure=backpressure,
+                                put_timeout=put_timeout,
+                                spill_dir=spill_dir)
+
+    def __call__(self, name, start_doc):
+        serializer = Serializer(self._db, writer_pool=self._pool,
+                                journal=self._journal, **self._kwargs)
+        return [serializer], []
+
+    @property
+    def fill_level(self):
+        """
+        The current fill level of the shared workers, see
+        ``WriterPool.fill_level``.
+        """
+        return self._pool.fill_level
+
+    def close(self):
+        """
+        Stops the workers, once every queued document has been written.
+        """
+        self._pool.close()
+        if self._private_journal:
+            self._journal.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_details):
+        self.close()
+
+
+# The key that each kind of event or datum document is routed by.
+_STREAM_KEYS = {'event': 'descriptor', 'event_page': 'descriptor',
+                'datum': 'resource', 'datum_page': 'resource'}
+_PAGES = {'event_page', 'datum_page'}
+
+
+# The numpy dtypes of scalar data keys, by their JSON dtype.
+_SCALAR_DTYPES = {'number': '<f8', 'integer': '<i8', 'boolean': '|b1'}
+
+
+
+def _column_dtypes(data_keys):
+    """
+    Returns the (dtype, shape) pairs of the data keys of a descriptor that
+    can be stored as binary columns.
+
+    Arrays are only stored as binary if their data key gives a numpy dtype
+    and a fixed shape. External data keys hold datum ids, and are not.
+    """
+    dtypes = {}
+    for key, data_key in data_keys.items():
+        if data_key.get('external'):
+            continue
+        shape = list(data_key.get('shape') or [])
+        dtype = data_key.get('dtype_numpy') or data_key.get('dtype_str')
+        if dtype is None and not shape:
+            dtype = _SCALAR_DTYPES.get(data_key.get('dtype'))
+        if not isinstance(dtype, str):
+            continue
+        try:
+            kind = numpy.dtype(dtype).kind
+        except TypeError:
+            continue
+        if kind in 'biuf' and all(isinstance(length, int) and length > 0
+                                  for length in shape):
+            dtypes[key] = (dtype, shape)
+    return dtypes
+
+
+def _encode_event_page(event_page, dtypes, compress=False):
+    """
+    Returns a copy of an event_page whose time, seq_num and binary data
+    columns are each replaced by a list of chunks. If compress is True, the
+    timestamps are replaced too, and time, seq_num and timestamps are
+    compressed.
+    """
+    encoded = dict(event_page)
+    if compress:
+        encoded['time'] = _delta_column(event_page['time'])
+        encoded['seq_num'] = _range_column(event_page['seq_num'])
+        encoded['timestamps'] = {
+            key: _delta_column(values)
+            for key, values in event_page['timestamps'].items()}
+    else:
+        encoded['time'] = _pack_column(event_page['time'], '<f8', [])
+        encoded['seq_num'] = _pack_column(event_page['seq_num'], '<i8', [])
+    encoded['data'] = {key: (_pack_column(values, *dtypes[key])
+                             if key in dtypes else values)
+                       for key, values in event_page['data'].items()}
+    return encoded
+
+
+def _pack_column(values, dtype, shape):
+    """
+    Packs the values of a column into a binary chunk.
+
+    Values that cannot be cast to dtype without losing their kind, or that
+    do not have the shape, are returned as they are.
+    """
+    try:
+        packed = numpy.asarray(values)
+    except ValueError:
+        # The values are ragged.
+        return values
+    if (packed.shape != (len(values), *shape)
+            or not numpy.can_cast(packed.dtype, dtype, 'same_kind')):
+        return values
+    return [{'dtype': dtype, 'shape': list(packed.shape),
+             'bytes': bson.Binary(packed.astype(dtype, copy=False).tobytes())}]
+
+
+def _range_column(values):
+    """
+    Encodes each run of consecutive integers in a column as its start and
+    count. Columns that are not all integers are packed as they are.
+    """
+    packed = numpy.asarray(values)
+    if packed.dtype.kind not in 'iu' or packed.shape != (len(values),):
+        return _pack_column(values, '<i8', [])
+    # The indexes at which a new run starts.
+    starts = numpy.flatnonzero(numpy.diff(packed) != 1) + 1
+    bounds = [0, *starts.tolist(), len(values)]
+    return [{'start': int(packed[start]), 'count': stop - start}
+            for start, stop in zip(bounds, bounds[1:]) if stop > start]
+
+
+def _delta_column(values):
+    """
+    Delta-encodes a float column into one binary chunk.
+
+    The deltas are taken between the 64-bit patterns of the floats, which
+    is exact, and are stored in the narrowest integer dtype that holds all
+    of them. Values that are not numbers are returned as they are.
+    """
+    try:
+        packed = numpy.asarray(values)
+    except ValueError:
+        return values
+    if (not len(values) or packed.shape != (len(values),)
+            or packed.dtype.kind not in 'iuf'):
+        return values
+    bits = packed.astype('<f8', copy=False).view('<i8')
+    # Integer overflow wraps around, and wraps back when decoded.
+    deltas = numpy.diff(bits)
+    for dtype in _DELTA_DTYPES:
+        limits = numpy.iinfo(dtype)
+        if not len(deltas) or (limits.min <= deltas.min()
+                               and deltas.max() <= limits.max):
+            break
+    return [{'first': int(bits[0]), 'dtype': dtype,
+             'deltas': bson.Binary(deltas.astype(dtype).tobytes())}]
+
+
+def decode_event_page(page):
+    """
+    Decodes the binary columns and uids of an event page read from the
+    database.
+
+    Binary chunks are read with ``numpy.frombuffer``, so a column that was
+    written in one chunk is a read-only view of the page's bytes, and is not
+    copied. The chunks of a column that was written several times are
+    concatenated. Binary UUIDs are converted back to strings.
+    """
+    decoded = dict(page)
+    decoded['uid'] = _decode_uids(page['uid'])
+    if page.get('encoding') in ('binary', 'compressed'):
+        decoded['time'] = _unpack_column(page['time'])
+        decoded['seq_num'] = _unpack_column(page['seq_num'])
+        decoded['data'] = {key: _unpack_column(values)
+                           for key, values in page['data'].items()}
+    if page.get('encoding') == 'compressed':
+        decoded['timestamps'] = {key: _unpack_column(values)
+                                 for key, values in page['timestamps'].items()}
+    return decoded
+
+
+def decode_datum_page(page):
+    """
+    Converts the binary UUIDs of a datum page read from the database back to
+    strings.
+    """
+    return {**page, 'datum_id': _decode_uids(page['datum_id'])}
+
+
+def uid_query(uid):
+    """
+    Returns the query value that matches a uid, or a datum_id, in pages
+    written with either uid_encoding.
+
+    For example, ``db.event.find_one({'uid': uid_query(uid)})`` finds the
+    page of an event.
+    """
+    encoded = _encode_uid(uid)
+    if encoded is uid:
+        return uid
+    return {'$in': [uid, encoded]}
+
+
+def _encode_uids(uids):
+    return [_encode_uid(uid) for uid in uids]
+
+
+def _encode_uid(uid):
+    """
+    Returns a canonical UUID string as a 16-byte BSON UUID. Other uids are
+    returned as they are.
+    """
+    if isinstance(uid, str) and len(uid) == 36:
+        try:
+            value = uuid.UUID(uid)
+        except ValueError:
+            return uid
+        # Only strings that convert back to themselves are encoded.
+        if str(value) == uid:
+            return bson.Binary(value.bytes, bson.binary.UUID_SUBTYPE)
+    return uid
+
+
+def _decode_uids(uids):
+    return [_decode_uid(uid) for uid in uids]
+
+
+def _decode_uid(uid):
+    # Depending on its uuidRepresentation, pymongo decodes BSON UUIDs as
+    # Binary or as uuid.UUID.
+    if isinstance(uid, bson.Binary) and uid.subtype == bson.binary.UUID_SUBTYPE:
+        return str(uuid.UUID(bytes=bytes(uid)))
+    if isinstance(uid, uuid.UUID):
+        return str(uid)
+    return uid
+
+
+def _unpack_column(column):
+    """
+    Returns the values of a column as a numpy array, if all of them were
+    packed, and as a list otherwise.
+    """
+    if not all(map(_is_chunk, column)):
+        # Some of the values were pushed as they are.
+        return list(itertools.chain.from_iterable(
+            _unpack_chunk(item) if _is_chunk(item) else [item]
+            for item in column))
+    arrays = [_unpack_chunk(chunk) for chunk in column]
+    if len(arrays) == 1:
+        return arrays[0]
+    if not arrays:
+        return column
+    return numpy.concatenate(arrays)
+
+
+def _is_chunk(item):
+    return isinstance(item, dict) and frozenset(item) in _CHUNK_DECODERS
+
+
+def _unpack_chunk(chunk):
+    return _CHUNK_DECODERS[frozenset(chunk)](chunk)
+
+
+def _decode_packed(chunk):
+    return numpy.frombuffer(chunk['bytes'],
+                            dtype=chunk['dtype']).reshape(chunk['shape'])
+
+
+def _decode_range(chunk):
+    return numpy.arange(chunk['start'], chunk['start'] + chunk['count'],
+                        dtype='<i8')
+
+
+def _decode_deltas(chunk):
+    deltas = numpy.frombuffer(chunk['deltas'], dtype=chunk['dtype'])
+    bits = numpy.empty(len(deltas) + 1, dtype='<i8')
+    bits[0] = chunk['first']
+    numpy.cumsum(deltas, dtype='<i8', out=bits[1:])
+    bits[1:] += bits[0]
+    return bits.view('<f8')
+
+
+# The decoder of each kind of chunk, by its keys.
+_CHUNK_DECODERS = {frozenset({'dtype', 'shape', 'bytes'}): _decode_packed,
+                   frozenset({'start', 'count'}): _decode_range,
+                   frozenset({'first', 'dtype', 'deltas'}): _decode_deltas}
+
+# The integer dtypes that deltas are stored in, narrowest first.
+_DELTA_DTYPES = ('<i1', '<i2', '<i4', '<i8')
+
+
+# The fields that every event has, and the ones that it may have.
+_EVENT_FIELDS = frozenset(['uid', 'time', 'seq_num', 'descriptor', 'data',
+                           'timestamps'])
+_EVENT_KEYS = _EVENT_FIELDS | {'filled'}
+
+
+def _key_paths(data_keys):
+    """
+    Returns the paths that the values of the data keys of a descriptor are
+    pushed to, for each of data, timestamps and filled.
+    """
+    return {frame: {key: f'{frame}.{key}' for key in data_keys}
+            for frame in ('data', 'timestamps', 'filled')}
+
+
+def _is_transient(error):
+    """
+    Returns True if a write that raised the error can be retried.
+    """
+    return (isinstance(error, pymongo.errors.ConnectionFailure)
+            or error.has_error_label('RetryableWriteError'))
+
+
+def _is_applied(collection, operation, write_error):
+    """
+    Returns True if a page update failed with a duplicate key error because
+    the page already holds it.
+    """
+    if write_error.get('code') != 11000:
+        return False
+    # The filter of a page update is {'_id': ..., 'last_index': {'$lt': ...}}.
+    page_filter = operation._filter
+    return bool(collection.count_documents(
+        {'_id': page_filter['_id'],
+         'last_index': {'$gte': page_filter['last_index']['$lt']}}))
+
+
+def _indexes():
+    """
+    Returns the indexes of this layout.
+
+    The indexes are given as a dict that maps collection names to lists of
+    (keys, options) pairs.
+    """
+    ASCENDING = pymongo.ASCENDING
+    DESCENDING = pymongo.DESCENDING
+    return {
+        'header': [
+            ([('run_id', ASCENDING)], {'unique': True}),
+            ([('resources.uid', ASCENDING)], {'unique': True, 'sparse': True}),
+            ([('resources.resource_id', ASCENDING)], {}),  # legacy
+            ([('start.uid', DESCENDING)], {'unique': True, 'sparse': True}),
+            ([('start.time', DESCENDING), ('start.scan_id', DESCENDING)],
+             {'unique': False, 'background': True}),
+            ([('$**', 'text')], {}),
+            ([('stop.run_start', ASCENDING)], {'unique': True, 'sparse': True}),
+            ([('stop.uid', ASCENDING)], {'unique': True, 'sparse': True}),
+            ([('stop.time', DESCENDING)],
+             {'unique': False, 'background': True, 'sparse': True}),
+            ([('descriptors.uid', DESCENDING)],
+             {'unique': True, 'sparse': True}),
+            ([('descriptors.run_start', DESCENDING), ('time', DESCENDING)],
+             {'unique': False, 'background': True}),
+            ([('descriptors.time', DESCENDING)],
+             {'unique': False, 'background': True}),
+        ],
+        'event': [
+            ([('uid', DESCENDING)], {'unique': True, 'sparse': True}),
+            ([('descriptor', DESCENDING), ('time.0', ASCENDING)],
+             {'unique': False, 'background': True}),
+        ],
+        'datum': [
+            ([('datum_id', ASCENDING)], {'unique': True, 'sparse': True}),
+            ([('resource', ASCENDING)], {}),
+        ],
+    }
+
+
 class Embedder():
 
     """
@@ -490,16 +1696,20 @@ class Embedder():
     are defined by the bluesky event-model.
 
     Events with different descriptors, or datum with different resources are
-    stored in separate embedded documents. Embedder uses a defaultdict so new
-    embedded documents are automatically created when they are needed. The dump
-    method returns the embedded dictionary. This mechanism manages the lifetime
-    of the event streams in the buffer.
+    stored in separate embedded documents. New embedded documents are
+    automatically created when they are needed. The dump method returns the
+    embedded dictionary. This mechanism manages the lifetime of the event
+    streams in the buffer.
 
     The doc_type argument which can be either 'event' or 'datum'.
     The the details of the embedding differ for event and datum documents.
 
-    Internally the embedder is a dictionary that maps event decriptors to
-    event_pages or datum resources to datum_pages.
+    Internally the embedder is a dictionary that maps event decriptors or
+    datum resources to columnar stream buffers. Values are appended to the
+    columns in place; integer and float columns are packed into typed arrays.
+    The buffers are converted to event_pages or datum_pages only when they
+    are dumped. The columns of event streams whose descriptors have been
+    given to ``describe`` are laid out ahead of time.
 
     Parameters
     ----------
@@ -516,10 +1726,13 @@ class Embedder():
     """
 
     def __init__(self, doc_type, max_size):
-        self._embedder = defaultdict(lambda: defaultdict(lambda:
-                                                         defaultdict(list)))
+        self._embedder = {}
         self.current_size = 0
-        self.stream_size = defaultdict(lambda: 0)
+        self._first_insert = None
+        # Maps each stream to the function used to size its documents.
+        self._size_funcs = {}
+        # Maps each described stream to its _StreamLayout.
+        self._layouts = {}
 
         if (max_size >= 1000) and (max_size <= 15000000):
             self._max_size = max_size
@@ -542,6 +1755,24 @@ class Embedder():
             raise ValueError(f"Invalid doc_type {doc_type}, doc_type must "
                              "be either 'event' or 'datum'")
 
+    def describe(self, descriptor):
+        """
+        Lays out the columns of an event stream from its descriptor.
+
+        The events of the stream that have the data keys of the descriptor,
+        as they nearly always do, are then embedded with one pass over a
+        fixed list of columns, and are sized with a function chosen from the
+        shapes of the data keys. Other events are embedded as usual.
+        """
+        self._layouts[descriptor['uid']] = _StreamLayout(
+            descriptor['data_keys'])
+
+    def forget(self, stream_id):
+        """
+        Forgets the layout of a stream, once it has been written.
+        """
+        self._layouts.pop(stream_id, None)
+
     def dump(self):
         """
         Get everything that has been embedded  and clear the buffer.
@@ -553,27 +1784,40 @@ class Embedder():
             dictionary that maps datum resource to datum_page.
         """
         # Get a reference to the current dict, create a new dict.
-        embedder_dump = self._embedder
-        self._embedder = defaultdict(lambda: defaultdict(lambda:
-                                                         defaultdict(list)))
-        dump_sizes = dict(self.stream_size)
-        self.stream_size = defaultdict(lambda: 0)
+        stream_buffers = self._embedder
+        self._embedder = {}
         self.current_size = 0
+        self._first_insert = None
+        self._size_funcs = {}
+        embedder_dump = {stream_id: stream_buffer.to_page()
+                         for stream_id, stream_buffer in stream_buffers.items()}
+        dump_sizes = {stream_id: stream_buffer.size
+                      for stream_id, stream_buffer in stream_buffers.items()}
         return embedder_dump, dump_sizes
 
-    def insert(self, doc):
+    def insert(self, doc, doc_size=None):
         """
         Embeds a bluesky event or datum document.
         Parameters
         ----------
         doc: json
             A validated bluesky event or datum document.
+        doc_size: int, optional
+            The size of the document, if it is already known.
         Returns
         -------
         result: bool
             True if insert is successful, False if it failed.
         """
-        doc_size = len(bson.BSON.encode(doc))
+        stream_id = doc[self._stream_id_key]
+        if doc_size is None:
+            size_func = self._size_funcs.get(stream_id)
+            if size_func is None:
+                layout = self._layouts.get(stream_id)
+                size_func = self._size_funcs[stream_id] = (
+                    _size_function(doc) if layout is None
+                    else layout.size_func)
+            doc_size = size_func(doc)
         if doc_size > self._max_size:
             raise ValueError(f"Document size is too large to fit in the "
                              f"embedder. doc_size={doc_size}, "
@@ -583,21 +1827,352 @@ class Embedder():
         if (self.current_size + doc_size) > self._max_size:
             return doc
 
+        stream_buffer = self._embedder.get(stream_id)
+        if stream_buffer is None:
+            stream_buffer = self._embedder[stream_id] = _StreamBuffer(
+                self._array_keys, self._dataframe_keys,
+                self._layouts.get(stream_id))
+            if self._first_insert is None:
+                self._first_insert = stream_buffer.first_insert
+
+        if stream_buffer.layout is not None and stream_buffer.layout.fits(doc):
+            stream_buffer.insert_described(doc)
+            self.current_size += doc_size
+            stream_buffer.size += doc_size
+            return None
+
+        arrays = stream_buffer.arrays
+        frames = stream_buffer.frames
         for key, value in doc.items():
-            if key in self._array_keys:
-                self._embedder[doc[self._stream_id_key]][key] = list(
-                    self._embedder[doc[self._stream_id_key]][key])
-                self._embedder[doc[self._stream_id_key]][key].append(value)
-            elif key in self._dataframe_keys:
-                for inner_key, inner_value in doc[key].items():
-                    (self._embedder[doc[self._stream_id_key]][key]
-                        [inner_key].append(inner_value))
+            if key in arrays:
+                arrays[key].append(value)
+            elif key in frames:
+                frame = frames[key]
+                for inner_key, inner_value in value.items():
+                    column = frame.get(inner_key)
+                    if column is None:
+                        column = frame[inner_key] = _Column()
+                    column.append(inner_value)
             else:
-                self._embedder[doc[self._stream_id_key]][key] = value
+                stream_buffer.fields[key] = value
 
         self.current_size += doc_size
-        self.stream_size[doc[self._stream_id_key]] += doc_size
+        stream_buffer.size += doc_size
         return None
 
     def empty(self):
         return not self.current_size
+
+    def age(self):
+        """
+        Returns how long, in seconds, the oldest embedded document has been
+        in the embedder.
+        """
+        if self._first_insert is None:
+            return 0
+        return time.monotonic() - self._first_insert
+
+    def insert_times(self):
+        """
+        Returns a dictionary that maps each stream to the time.monotonic()
+        value of its first insert since the last dump.
+        """
+        return {stream_id: stream_buffer.first_insert
+                for stream_id, stream_buffer in self._embedder.items()}
+
+
+class _Page():
+    """
+    An event_page or datum_page waiting in a worker's queue.
+    """
+
+    __slots__ = ('stream_id', 'doc', 'size', 'enqueue_time')
+
+    def __init__(self, stream_id, doc, size=None):
+        self.stream_id = stream_id
+        self.doc = doc
+        self.size = size
+        self.enqueue_time = time.monotonic()
+
+
+class _Flush():
+    """
+    A marker that asks a worker to write its embedder, and is set when done.
+    """
+
+    __slots__ = ('done',)
+
+    def __init__(self):
+        self.done = Event()
+
+
+def _split_page(page, max_size):
+    """
+    Splits an event_page or datum_page into pages of at most max_size bytes.
+
+    Every list in the page, including the lists in its data, timestamps,
+    filled and datum_kwargs dictionaries, is sliced the same way. Yields
+    (page, size) pairs in order.
+    """
+    size = _bson_size(page)
+    if size <= max_size:
+        yield page, size
+        return
+    length = max(len(value) for value in page.values()
+                 if isinstance(value, list))
+    rows = max(1, length * max_size // size)
+    start = 0
+    while start < length:
+        chunk = _slice_page(page, start, start + rows)
+        chunk_size = _bson_size(chunk)
+        # Rows can differ in size, so the estimate is checked.
+        while chunk_size > max_size:
+            if rows == 1:
+                raise ValueError(f"Page row {start} is too large to fit in "
+                                 f"the embedder. max_size={max_size}")
+            rows //= 2
+            chunk = _slice_page(page, start, start + rows)
+            chunk_size = _bson_size(chunk)
+        yield chunk, chunk_size
+        start += rows
+
+
+def _slice_page(page, start, stop):
+    sliced = {}
+    for key, value in page.items():
+        if isinstance(value, list):
+            sliced[key] = value[start:stop]
+        elif isinstance(value, dict):
+            sliced[key] = {inner_key: inner_value[start:stop]
+                           for inner_key, inner_value in value.items()}
+        else:
+            sliced[key] = value
+    return sliced
+
+
+_INT32_MIN = -2 ** 31
+_INT32_MAX = 2 ** 31 - 1
+_ARRAY_TYPES = (list, tuple)
+
+# _INDEX_KEYS_SIZES[n] is the size of the keys '0' ... 'n-1' of a BSON array,
+# including their type bytes and null terminators.
+_INDEX_KEYS_SIZES = [0]
+
+
+def _index_keys_size(length):
+    sizes = _INDEX_KEYS_SIZES
+    while len(sizes) <= length:
+        sizes.append(sizes[-1] + len(str(len(sizes) - 1)) + 2)
+    return sizes[length]
+
+
+def _encoded_size(doc):
+    return len(bson.encode(doc, codec_options=NUMPY_CODEC_OPTIONS))
+
+
+def _size_function(doc):
+    """
+    Returns the function used to size the documents of a stream.
+
+    The structure of a stream does not change, so this is decided once from
+    its first document. The C encoder is fastest for scalar documents,
+    _bson_size is fastest for documents with arrays in them.
+    """
+    if any(_has_arrays(value) for value in doc.values()):
+        return _bson_size
+    return _encoded_size
+
+
+def _has_arrays(value):
+    if isinstance(value, dict):
+        return any(isinstance(inner_value, _ARRAY_TYPES)
+                   for inner_value in value.values())
+    return isinstance(value, _ARRAY_TYPES)
+
+
+def _bson_size(doc):
+    """
+    Returns the exact size of a document encoded as BSON, without encoding it.
+
+    Arrays of floats, ints or strings are sized with a few vectorized
+    operations instead of element by element. Types that are not handled
+    here fall back to the bson encoder.
+    """
+    return (5 + 2 * len(doc) + len(''.join(doc).encode())
+            + sum(map(_value_size, doc.values())))
+
+
+def _array_size(values):
+    size = 5 + _index_keys_size(len(values))
+    kinds = set(map(type, values))
+    if len(kinds) == 1:
+        kind, = kinds
+        if kind is float:
+            return size + 8 * len(values)
+        if kind is str:
+            return size + 5 * len(values) + len(''.join(values).encode())
+        if (kind is int and _INT32_MIN <= min(values)
+                and max(values) <= _INT32_MAX):
+            return size + 4 * len(values)
+    return size + sum(map(_value_size, values))
+
+
+def _int_size(value):
+    return 4 if _INT32_MIN <= value <= _INT32_MAX else 8
+
+
+_VALUE_SIZES = {
+    float: lambda value: 8,
+    int: _int_size,
+    bool: lambda value: 1,
+    type(None): lambda value: 0,
+    str: lambda value: 5 + len(value.encode()),
+    bson.Binary: lambda value: 5 + len(value),
+    dict: _bson_size,
+    list: _array_size,
+    tuple: _array_size,
+}
+
+
+def _value_size(value):
+    try:
+        return _VALUE_SIZES[type(value)](value)
+    except KeyError:
+        # Encode the value in a document with an empty key: 4 bytes of
+        # length, 1 type byte, 1 byte for the key and 1 terminator.
+        return len(bson.encode({'': value},
+                               codec_options=NUMPY_CODEC_OPTIONS)) - 7
+
+
+# Typed array codes for the column types that can be packed.
+_TYPECODES = {int: 'q', float: 'd'}
+
+
+class _Column():
+    """
+    Append-only column of an embedded document.
+
+    Integers and floats are packed into a typed array. If the column holds
+    any other type, or a mix of types, it falls back to a plain list.
+    """
+
+    __slots__ = ('kind', 'values')
+
+    def __init__(self):
+        self.kind = None
+        self.values = []
+
+    def append(self, value):
+        kind = type(value)
+        if kind is self.kind:
+            try:
+                self.values.append(value)
+                return
+            except OverflowError:
+                pass
+        elif self.kind is None and not self.values and kind in _TYPECODES:
+            self.kind = kind
+            self.values = array.array(_TYPECODES[kind])
+            try:
+                self.values.append(value)
+                return
+            except OverflowError:
+                pass
+        if self.kind is not None:
+            self.values = self.values.tolist()
+            self.kind = None
+        self.values.append(value)
+
+    def tolist(self):
+        if self.kind is None:
+            return self.values
+        return self.values.tolist()
+
+
+class _StreamLayout():
+    """
+    The data keys of a described event stream, and the function that sizes
+    its events.
+    """
+
+    __slots__ = ('keys', 'key_set', 'size_func')
+
+    def __init__(self, data_keys):
+        self.keys = tuple(data_keys)
+        self.key_set = frozenset(data_keys)
+        # Arrays are sized fastest by _bson_size, scalars by the C encoder;
+        # see _size_function.
+        if any(data_key.get('shape') for data_key in data_keys.values()):
+            self.size_func = _bson_size
+        else:
+            self.size_func = _encoded_size
+
+    def fits(self, doc):
+        """
+        Returns True if an event has exactly the fields and data keys of the
+        layout, and no others.
+        """
+        return (_EVENT_FIELDS <= doc.keys() <= _EVENT_KEYS
+                and doc['data'].keys() == self.key_set
+                and doc['timestamps'].keys() == self.key_set)
+
+
+class _StreamBuffer():
+    """
+    Columnar buffer for the embedded documents of one stream.
+    """
+
+    __slots__ = ('fields', 'arrays', 'frames', 'size', 'first_insert',
+                 'layout', 'columns')
+
+    def __init__(self, array_keys, dataframe_keys, layout=None):
+        self.fields = {}
+        self.arrays = {key: _Column() for key in array_keys}
+        self.frames = {key: {} for key in dataframe_keys}
+        self.size = 0
+        self.first_insert = time.monotonic()
+        self.layout = layout
+        if layout is not None:
+            # The data and timestamps columns of each data key.
+            data, timestamps = self.frames['data'], self.frames['timestamps']
+            self.columns = [
+                (key,
+                 data.setdefault(key, _Column()),
+                 timestamps.setdefault(key, _Column()))
+                for key in layout.keys]
+
+    def insert_described(self, doc):
+        """
+        Embeds an event that fits the layout of the stream.
+        """
+        arrays = self.arrays
+        arrays['uid'].append(doc['uid'])
+        arrays['time'].append(doc['time'])
+        arrays['seq_num'].append(doc['seq_num'])
+        data = doc['data']
+        timestamps = doc['timestamps']
+        for key, data_column, timestamps_column in self.columns:
+            data_column.append(data[key])
+            timestamps_column.append(timestamps[key])
+        # Only the data keys that are filled from external files have a
+        # filled value, so these columns are still made as they are needed.
+        filled = doc.get('filled')
+        if filled:
+            frame = self.frames['filled']
+            for key, value in filled.items():
+                column = frame.get(key)
+                if column is None:
+                    column = frame[key] = _Column()
+                column.append(value)
+        self.fields['descriptor'] = doc['descriptor']
+
+    def to_page(self):
+        """
+        Returns the buffer as an event_page or datum_page.
+        """
+        return {**self.fields,
+                **{key: column.tolist()
+                   for key, column in self.arrays.items()},
+                **{key: {inner_key: column.tolist()
+                         for inner_key, column in frame.items()}
+                   for key, frame in self.frames.items()}}
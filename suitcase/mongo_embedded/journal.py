@@ -0,0 +1,311 @@
+"""
+A local write-ahead journal for the embedded Serializer.
+
+Documents handed to the Serializer are held in memory until the workers
+write them to MongoDB. With a journal, each document is first appended to a
+segment file on local disk, so that the runs that were being written when
+the process crashed, or when the database could not be reached, can be
+written later with ``replay``.
+
+Segments are files of BSON records, named by an increasing number. A new
+segment is started when the current one reaches segment_size, and segments
+are removed once every run that has records in them has been finalized.
+"""
+import os
+import threading
+
+import bson
+import event_model
+
+from suitcase.mongo_utils import NUMPY_CODEC_OPTIONS
+
+_SUFFIX = '.journal'
+
+
+class Journal():
+    """
+    An append-only journal of bluesky documents.
+
+    A Journal can be shared by the Serializers of many runs. Records are
+    written with one unbuffered write each, so they survive a crash of the
+    process as soon as they are appended, and are fsynced in batches so that
+    they also survive a crash of the machine.
+
+    Parameters
+    ----------
+    directory: str
+        Directory of the segment files. It is created if it does not exist.
+        Segments that are already there are left for ``replay``.
+    segment_size: int, optional
+        Size, in bytes, at which a new segment is started. Default is
+        64000000.
+    fsync_interval: float or None, optional
+        Maximum time, in seconds, between appending a record and fsyncing it.
+        If 0, every record is fsynced before it is acknowledged. If None,
+        segments are only fsynced when they are completed or closed. Default
+        is 0.1.
+    """
+
+    def __init__(self, directory, segment_size=64000000, fsync_interval=0.1):
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._segment_size = segment_size
+        self._fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._closed = False
+        # Maps the number of each segment written by this Journal to the
+        # runs with records in it that are not finalized yet.
+        self._segment_runs = {}
+        existing = _segment_numbers(directory)
+        self._number = existing[-1] if existing else 0
+        self._file = None
+        self._size = 0
+        self._dirty = False
+        self._open_segment()
+        self._syncer = None
+        self._closing = threading.Event()
+        if fsync_interval:
+            self._syncer = threading.Thread(target=self._sync_worker,
+                                            daemon=True)
+            self._syncer.start()
+
+    @property
+    def directory(self):
+        return self._directory
+
+    def append(self, run_uid, name, doc):
+        """
+        Appends a document of a run to the journal.
+        """
+        record = bson.encode({'run': run_uid, 'name': name, 'doc': doc},
+                             codec_options=NUMPY_CODEC_OPTIONS)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Cannot append to a closed Journal.")
+            if self._size and self._size + len(record) > self._segment_size:
+                self._close_segment()
+                self._open_segment()
+            os.write(self._file, record)
+            self._size += len(record)
+            self._segment_runs[self._number].add(run_uid)
+            if self._fsync_interval == 0:
+                os.fsync(self._file)
+            else:
+                self._dirty = True
+
+    def finish(self, run_uid):
+        """
+        Records that a run has been written to the database, and removes the
+        segments that are no longer needed.
+        """
+        with self._lock:
+            for number, runs in list(self._segment_runs.items()):
+                runs.discard(run_uid)
+                if not runs and number != self._number:
+                    os.remove(_segment_path(self._directory, number))
+                    del self._segment_runs[number]
+
+    def sync(self):
+        """
+        fsyncs the records appended so far.
+        """
+        with self._lock:
+            if self._dirty and not self._closed:
+                os.fsync(self._file)
+                self._dirty = False
+
+    def close(self):
+        """
+        fsyncs and closes the current segment. It is removed if every run in
+        it has been finished.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._close_segment()
+            if not self._segment_runs.get(self._number):
+                os.remove(_segment_path(self._directory, self._number))
+                self._segment_runs.pop(self._number, None)
+        self._closing.set()
+        if self._syncer is not None:
+            self._syncer.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_details):
+        self.close()
+
+    def _open_segment(self):
+        self._number += 1
+        self._file = os.open(_segment_path(self._directory, self._number),
+                             os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._size = 0
+        self._segment_runs[self._number] = set()
+
+    def _close_segment(self):
+        os.fsync(self._file)
+        os.close(self._file)
+        self._dirty = False
+
+    def _sync_worker(self):
+        while not self._closing.wait(self._fsync_interval):
+            self.sync()
+
+
+def read_journal(directory):
+    """
+    Yields the (run_uid, name, doc) records of the journal, in order.
+
+    A record that was only partially written, at the end of a segment, is
+    ignored.
+    """
+    for number in _segment_numbers(directory):
+        with open(_segment_path(directory, number), 'rb') as segment:
+            data = segment.read()
+        offset = 0
+        while offset + 4 <= len(data):
+            length = int.from_bytes(data[offset:offset + 4], 'little')
+            if length < 5 or offset + length > len(data):
+                break
+            try:
+                record = bson.decode(data[offset:offset + length])
+            except bson.errors.InvalidBSON:
+                break
+            yield record['run'], record['name'], record['doc']
+            offset += length
+
+
+def replay(directory, db, remove=True, **kwargs):
+    """
+    Writes the runs in a journal to the database.
+
+    Replay is idempotent: runs that have a stop document in the database are
+    skipped, and the documents of the other runs that are already in the
+    database are not written again. The run's remaining events and datum
+    are appended to the pages that its streams were last writing to, and
+    its counts continue from the documents in the database. Runs that have
+    no stop document in the journal are written, but not stopped.
+
+    Parameters
+    ----------
+    directory: str
+        Directory of the journal's segment files.
+    db: pymongo database or URI
+    remove: bool, optional
+        Remove the segments once they have been replayed. Default is True.
+    **kwargs:
+        Passed to the Serializers that write the runs.
+
+    Returns
+    -------
+    runs: dict
+        Maps the uid of each replayed run to True if it was stopped, False if
+        it was written but not stopped, or None if it was already complete.
+    """
+    from suitcase.mongo_embedded import Serializer
+
+    runs = {}
+    for run_uid, name, doc in read_journal(directory):
+        runs.setdefault(run_uid, []).append((name, doc))
+
+    numbers = _segment_numbers(directory)
+    results = {}
+    for run_uid, documents in runs.items():
+        serializer = Serializer(db, **kwargs)
+        try:
+            results[run_uid] = _replay_run(serializer, run_uid, documents)
+        finally:
+            serializer._pool.close()
+    if remove:
+        for number in numbers:
+            os.remove(_segment_path(directory, number))
+    return results
+
+
+def _replay_run(serializer, run_uid, documents):
+    """
+    Resumes a run in a new Serializer and writes the documents of the run
+    that are not in the database yet.
+    """
+    db = serializer._db
+    header = db.header.find_one({'run_id': run_uid})
+    if header is not None and header.get('stop'):
+        return None
+
+    written = {}
+    if header is not None:
+        serializer._resume(header)
+        for doc_type, key in (('descriptors', 'uid'), ('resources', 'uid')):
+            written[doc_type] = {doc[key] for doc in header.get(doc_type, [])}
+        for descriptor in written['descriptors']:
+            written.setdefault('event', set()).update(
+                serializer._resume_stream('event', descriptor))
+        for resource in written['resources']:
+            written.setdefault('datum', set()).update(
+                serializer._resume_stream('datum', resource))
+
+    stopped = False
+    for name, doc in documents:
+        if header is not None:
+            doc = _unwritten(name, doc, written)
+            if doc is None:
+                continue
+        if name == 'stop':
+            stopped = True
+        serializer(name, doc)
+    if not stopped:
+        serializer._pool.flush()
+        serializer._update_counts()
+        serializer._raise_worker_error()
+    return stopped
+
+
+def _unwritten(name, doc, written):
+    """
+    Returns the part of a journaled document that is not in the database,
+    or None if all of it is.
+    """
+    if name == 'start':
+        return None
+    if name == 'descriptor':
+        return None if doc['uid'] in written['descriptors'] else doc
+    if name == 'resource':
+        return None if doc['uid'] in written['resources'] else doc
+    if name == 'event':
+        return None if doc['uid'] in written.get('event', ()) else doc
+    if name == 'datum':
+        return (None if doc['datum_id'] in written.get('datum', ())
+                else doc)
+    if name == 'event_page':
+        keep = [uid not in written.get('event', ()) for uid in doc['uid']]
+        if not any(keep):
+            return None
+        if all(keep):
+            return doc
+        events = [event for event, kept
+                  in zip(event_model.unpack_event_page(doc), keep) if kept]
+        return event_model.pack_event_page(*events)
+    if name == 'datum_page':
+        keep = [datum_id not in written.get('datum', ())
+                for datum_id in doc['datum_id']]
+        if not any(keep):
+            return None
+        if all(keep):
+            return doc
+        datums = [datum for datum, kept
+                  in zip(event_model.unpack_datum_page(doc), keep) if kept]
+        return event_model.pack_datum_page(*datums)
+    return doc
+
+
+def _segment_path(directory, number):
+    return os.path.join(directory, f'{number:010d}{_SUFFIX}')
+
+
+def _segment_numbers(directory):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(int(name[:-len(_SUFFIX)]) for name in os.listdir(directory)
+                  if name.endswith(_SUFFIX) and name[:-len(_SUFFIX)].isdigit())
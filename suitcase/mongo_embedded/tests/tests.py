@@ -1,8 +1,24 @@
 # Tests should generate (and then clean up) any files they need for testing. No
 # binary files should be included in the repository.
+import bson
+from bson.raw_bson import RawBSONDocument
+import datetime
 import json
+import os
+from collections import defaultdict
+import threading
+import time
 import event_model
-from suitcase.mongo_embedded import Serializer
+import numpy
+import pymongo
+from suitcase.mongo_embedded import (BackpressureError, Embedder, Serializer,
+                                     SerializerFactory, _SpillFile,
+                                     _bson_size,
+                                     _delta_column, _range_column,
+                                     _unpack_column,
+                                     decode_datum_page, decode_event_page,
+                                     uid_query)
+from suitcase.mongo_embedded.journal import Journal, read_journal, replay
 import pytest
 
 
@@ -28,6 +44,163 @@ def test_multithread(db_factory, example_data):
         serializer.close()
 
 
+def test_multithread_partitions(db_factory, example_data):
+    """
+    Test that streams are spread across the worker threads.
+    """
+    permanent_db = db_factory()
+    serializer = Serializer(permanent_db, num_threads=3)
+    # Streams are released when the run is finalized.
+    snapshots = []
+    unregister = serializer._pool.unregister
+
+    def snapshot_unregister(serializer):
+        snapshots.extend(dict(partitions) for partitions
+                         in serializer._pool._partitions.values())
+        unregister(serializer)
+
+    serializer._pool.unregister = snapshot_unregister
+    run(example_data, serializer, permanent_db)
+    assert len(snapshots) == 2
+    for partitions in snapshots:
+        assert (len(set(partitions.values()))
+                == min(len(partitions), 3))
+    if not serializer._frozen:
+        serializer.close()
+
+
+def test_serializer_factory(db_factory, example_data):
+    """
+    Test that the Serializers of many runs share one WriterPool.
+    """
+    permanent_db = db_factory()
+    factory = SerializerFactory(permanent_db, num_threads=2)
+    router = event_model.RunRouter([factory])
+    threads_before = threading.active_count()
+    for _ in range(3):
+        run(example_data, router, permanent_db)
+        # No threads are started for a run.
+        assert threading.active_count() == threads_before
+    assert not factory._pool._serializers
+    assert not factory._pool._owners
+    factory.close()
+    assert factory._pool._closed
+
+
+def test_raw_bson(db_factory, example_data):
+    """
+    Test suitcase-mongo-embedded serializer with pre-encoded documents.
+    """
+    permanent_db = db_factory()
+    serializer = Serializer(permanent_db)
+
+    def raw_serializer(name, doc):
+        return serializer(name, RawBSONDocument(bson.encode(doc)))
+
+    run(example_data, raw_serializer, permanent_db)
+
+
+def test_binary_pages(db_factory, example_data):
+    """
+    Test suitcase-mongo-embedded serializer with binary page columns.
+    """
+    permanent_db = db_factory()
+    serializer = Serializer(permanent_db, page_encoding='binary',
+                            embedder_size=3000)
+    run(example_data, serializer, permanent_db)
+    assert permanent_db.event.count_documents({'encoding': 'binary'})
+
+
+def test_decode_binary_page(db_factory):
+    """
+    Test that binary columns are decoded into numpy arrays.
+    """
+    permanent_db = db_factory()
+    serializer = Serializer(permanent_db, page_encoding='binary')
+    run_bundle = event_model.compose_run()
+    serializer('start', run_bundle.start_doc)
+    descriptor_bundle = run_bundle.compose_descriptor(
+        name='primary',
+        data_keys={'x': {'source': 'x', 'dtype': 'number', 'shape': []},
+                   'y': {'source': 'y', 'dtype': 'array', 'shape': [2],
+                         'dtype_str': '<i4'},
+                   'z': {'source': 'z', 'dtype': 'string', 'shape': []}})
+    serializer('descriptor', descriptor_bundle.descriptor_doc)
+    for i in range(3):
+        serializer('event', descriptor_bundle.compose_event(
+            data={'x': i, 'y': [i, -i], 'z': str(i)},
+            timestamps={'x': 0.0, 'y': 0.0, 'z': 0.0}, seq_num=i + 1))
+    serializer('stop', run_bundle.compose_stop())
+
+    page = decode_event_page(permanent_db.event.find_one())
+    assert page['seq_num'].dtype == numpy.int64
+    assert page['seq_num'].tolist() == [1, 2, 3]
+    assert page['data']['x'].dtype == numpy.float64
+    assert page['data']['x'].tolist() == [0.0, 1.0, 2.0]
+    assert page['data']['y'].dtype == numpy.int32
+    assert page['data']['y'].tolist() == [[0, 0], [1, -1], [2, -2]]
+    assert page['data']['z'] == ['0', '1', '2']
+    # A column written in one chunk is not copied.
+    assert not page['data']['x'].flags.owndata
+
+
+def test_compressed_pages(db_factory, example_data):
+    """
+    Test suitcase-mongo-embedded serializer with compressed page columns.
+    """
+    permanent_db = db_factory()
+    serializer = Serializer(permanent_db, page_encoding='compressed',
+                            embedder_size=3000)
+    run(example_data, serializer, permanent_db)
+
+
+@pytest.mark.parametrize('values', [
+    [1.5e9 + 0.1 * i for i in range(100)],
+    [3.0, -1.0, float('nan'), float('inf'), 0.0, 1e300],
+    [1, 2, 3],
+    [7.0]])
+def test_delta_column(values):
+    column = _delta_column(values)
+    assert len(column) == 1
+    decoded = _unpack_column(column)
+    assert decoded.dtype == numpy.float64
+    numpy.testing.assert_array_equal(decoded, values)
+
+
+def test_delta_column_narrows():
+    column = _delta_column([1.5e9 + 0.1 * i for i in range(100)])
+    assert column[0]['dtype'] == '<i4'
+    assert len(column[0]['deltas']) == 99 * 4
+
+
+def test_range_column():
+    assert _range_column([1, 2, 3]) == [{'start': 1, 'count': 3}]
+    values = [1, 2, 3, 5, 6, 9, 8]
+    column = _range_column(values)
+    assert len(column) == 4
+    assert _unpack_column(column).tolist() == values
+    assert _range_column([1.5, 2.5]) == [1.5, 2.5]
+
+
+def test_binary_uids(db_factory, example_data):
+    """
+    Test suitcase-mongo-embedded serializer with binary UUIDs.
+    """
+    permanent_db = db_factory()
+    serializer = Serializer(permanent_db, uid_encoding='binary',
+                            page_encoding='binary')
+    run(example_data, serializer, permanent_db)
+    assert uid_query('not-a-uuid') == 'not-a-uuid'
+    page = permanent_db.event.find_one()
+    if page is None:
+        return
+    assert not isinstance(page['uid'][0], str)
+    uid = decode_event_page(page)['uid'][0]
+    assert isinstance(uid, str)
+    assert permanent_db.event.find_one({'uid': uid_query(uid)})['_id'] == (
+        page['_id'])
+
+
 def test_smallbuffer(db_factory, example_data):
     """
     Test suitcase-mongo-embedded serializer with a small buffer.
@@ -61,6 +234,364 @@ def test_smallpage(db_factory, example_data):
         serializer.close()
 
 
+def test_max_insert_time(db_factory):
+    """
+    Test that a steady trickle of events is written within max_insert_time.
+    """
+    permanent_db = db_factory()
+    serializer = Serializer(permanent_db, max_insert_time=0.1)
+    run_bundle = event_model.compose_run()
+    serializer('start', run_bundle.start_doc)
+    descriptor_bundle = run_bundle.compose_descriptor(
+        name='primary',
+        data_keys={'x': {'source': 'x', 'dtype': 'number', 'shape': []}})
+    serializer('descriptor', descriptor_bundle.descriptor_doc)
+    # Events arrive faster than the queue's idle timeout, so only the
+    # max_insert_time deadline triggers the writes.
+    for i in range(25):
+        serializer('event', descriptor_bundle.compose_event(
+            data={'x': i}, timestamps={'x': time.time()}))
+        time.sleep(0.02)
+    assert permanent_db.event.count_documents({}) > 0
+    latency = serializer.flush_latency[descriptor_bundle.descriptor_doc['uid']]
+    assert latency < 0.5
+    assert descriptor_bundle.descriptor_doc['uid'] in serializer.last_flush
+    serializer('stop', run_bundle.compose_stop())
+
+
+@pytest.mark.parametrize('backpressure', ['block', 'spill'])
+def test_memory_budget(db_factory, example_data, backpressure):
+    """
+    Test that runs are written in full with a small memory budget.
+    """
+    permanent_db = db_factory()
+    serializer = Serializer(permanent_db, embedder_size=3000,
+                            memory_budget=5000, backpressure=backpressure)
+    run(example_data, serializer, permanent_db)
+    fill_level = serializer.fill_level
+    assert fill_level['used'] == 0
+    assert fill_level['budget'] == 5000
+    assert fill_level['spilled'] == 0
+
+
+@pytest.mark.parametrize('backpressure', ['raise', 'block', 'spill'])
+def test_backpressure(db_factory, backpressure):
+    """
+    Test the backpressure policies while the workers are stalled.
+    """
+    permanent_db = db_factory()
+    serializer = Serializer(permanent_db, memory_budget=5000,
+                            backpressure=backpressure, put_timeout=0.2)
+    stalled = threading.Event()
+    bulkwrite_event = serializer._bulkwrite_event
+
+    def stalled_bulkwrite_event(*args):
+        stalled.wait()
+        bulkwrite_event(*args)
+
+    serializer._bulkwrite_event = stalled_bulkwrite_event
+    run_bundle = event_model.compose_run()
+    serializer('start', run_bundle.start_doc)
+    descriptor_bundle = run_bundle.compose_descriptor(
+        name='primary',
+        data_keys={'x': {'source': 'x', 'dtype': 'number', 'shape': [100]}})
+    serializer('descriptor', descriptor_bundle.descriptor_doc)
+    events = [descriptor_bundle.compose_event(
+        data={'x': [float(i)] * 100}, timestamps={'x': time.time()})
+        for i in range(20)]
+    if backpressure == 'spill':
+        for event in events:
+            serializer('event', event)
+        assert serializer.fill_level['spilled'] > 0
+    else:
+        with pytest.raises(BackpressureError):
+            for event in events:
+                serializer('event', event)
+        assert serializer.fill_level['used'] <= 5000
+    stalled.set()
+    serializer('stop', run_bundle.compose_stop())
+    assert serializer.fill_level['used'] == 0
+    written = [uid for page in permanent_db.event.find()
+               for uid in page['uid']]
+    if backpressure == 'spill':
+        assert written == [event['uid'] for event in events]
+    else:
+        assert written == [event['uid'] for event in events[:len(written)]]
+
+
+def test_backpressure_not_journaled(db_factory, tmp_path):
+    """
+    Test that documents rejected by backpressure are not journaled.
+    """
+    permanent_db = db_factory()
+    directory = str(tmp_path / 'journal')
+    serializer = Serializer(permanent_db, memory_budget=5000,
+                            backpressure='raise', journal=directory)
+    stalled = threading.Event()
+    bulkwrite_event = serializer._bulkwrite_event
+
+    def stalled_bulkwrite_event(*args):
+        stalled.wait()
+        bulkwrite_event(*args)
+
+    serializer._bulkwrite_event = stalled_bulkwrite_event
+    run_bundle = event_model.compose_run()
+    serializer('start', run_bundle.start_doc)
+    descriptor_bundle = run_bundle.compose_descriptor(
+        name='primary',
+        data_keys={'x': {'source': 'x', 'dtype': 'number', 'shape': [100]}})
+    serializer('descriptor', descriptor_bundle.descriptor_doc)
+    accepted = []
+    with pytest.raises(BackpressureError):
+        for i in range(20):
+            event = descriptor_bundle.compose_event(
+                data={'x': [float(i)] * 100}, timestamps={'x': time.time()})
+            serializer('event', event)
+            accepted.append(event['uid'])
+    journaled = [doc['uid'] for _, name, doc in read_journal(directory)
+                 if name == 'event']
+    assert journaled == accepted
+    stalled.set()
+    serializer('stop', run_bundle.compose_stop())
+
+
+def test_spill_file_unread(tmp_path):
+    """
+    Test that a spill file counts the bytes that have not been read back.
+    """
+    spill = _SpillFile(str(tmp_path))
+    first = spill.append(({'a': 1}, 10))
+    second = spill.append(({'b': 'two'}, 10))
+    assert spill.unread == first.length + second.length
+    assert spill.read(first) == ({'a': 1}, 10)
+    assert spill.unread == second.length
+    spill.read(second)
+    assert spill.unread == 0
+    spill.close()
+
+
+def journaled_run(serializer):
+    """
+    Sends a run with events, event pages, datum and datum pages.
+    """
+    run_bundle = event_model.compose_run()
+    serializer('start', run_bundle.start_doc)
+    descriptor_bundle = run_bundle.compose_descriptor(
+        name='primary',
+        data_keys={'x': {'source': 'x', 'dtype': 'number', 'shape': []}})
+    serializer('descriptor', descriptor_bundle.descriptor_doc)
+    resource_bundle = run_bundle.compose_resource(
+        spec='TIFF', root='/', resource_path='a', resource_kwargs={})
+    serializer('resource', resource_bundle.resource_doc)
+    for i in range(10):
+        serializer('event', descriptor_bundle.compose_event(
+            data={'x': i}, timestamps={'x': time.time()}))
+        serializer('datum', resource_bundle.compose_datum(
+            datum_kwargs={'i': i}))
+    serializer('event_page', descriptor_bundle.compose_event_page(
+        data={'x': [10, 11]}, timestamps={'x': [time.time()] * 2},
+        seq_num=[11, 12]))
+    serializer('datum_page', resource_bundle.compose_datum_page(
+        datum_kwargs={'i': [10, 11]}))
+    serializer('stop', run_bundle.compose_stop())
+    return run_bundle.start_doc['uid']
+
+
+def test_journal(db_factory, tmp_path):
+    """
+    Test that the journal keeps a run only until it has been written.
+    """
+    permanent_db = db_factory()
+    directory = str(tmp_path / 'journal')
+    serializer = Serializer(permanent_db, journal=directory)
+    journaled_run(serializer)
+    assert serializer._journal._closed
+    assert not os.listdir(directory)
+
+
+def test_journal_replay(db_factory, tmp_path):
+    """
+    Test that a run whose writes failed is completed by replaying the journal,
+    and that replaying is idempotent.
+    """
+    permanent_db = db_factory()
+    directory = str(tmp_path / 'journal')
+    journal = Journal(directory, fsync_interval=0)
+    serializer = Serializer(permanent_db, journal=journal)
+    # The first write of the events waits for the stop document and
+    # succeeds, the rest fail.
+    stopping = threading.Event()
+    bulkwrite_event = serializer._bulkwrite_event
+    calls = []
+
+    def failing_bulkwrite_event(*args):
+        calls.append(args)
+        if len(calls) > 1:
+            raise RuntimeError("Lost the database.")
+        stopping.wait()
+        bulkwrite_event(*args)
+
+    def send(name, doc):
+        if name == 'stop':
+            stopping.set()
+        serializer(name, doc)
+
+    serializer._bulkwrite_event = failing_bulkwrite_event
+    with pytest.raises(RuntimeError):
+        journaled_run(send)
+    journal.close()
+    run_uid = next(read_journal(directory))[0]
+    assert 'stop' not in permanent_db.header.find_one({'run_id': run_uid})
+
+    assert replay(directory, permanent_db, remove=False) == {run_uid: True}
+    assert replay(directory, permanent_db) == {run_uid: None}
+    assert not os.listdir(directory)
+
+    header = permanent_db.header.find_one({'run_id': run_uid})
+    assert len(header['stop']) == 1
+    assert len(header['descriptors']) == 1
+    assert len(header['resources']) == 1
+    assert header['event_count'] == 12
+    assert header['datum_count'] == 12
+    events = [event for page in permanent_db.event.find()
+              for event in event_model.unpack_event_page(page)]
+    assert [event['seq_num'] for event in events] == list(range(1, 13))
+    datum = [datum for page in permanent_db.datum.find()
+             for datum in event_model.unpack_datum_page(page)]
+    assert len({datum['datum_id'] for datum in datum}) == 12
+
+
+def test_bulk_write_retry(db_factory, monkeypatch):
+    """
+    Test that page writes are retried after transient errors, and that a
+    write whose acknowledgement was lost is not applied twice.
+    """
+    permanent_db = db_factory()
+    serializer = Serializer(permanent_db, retry_backoff=0.01)
+    collection_type = type(permanent_db.event)
+    bulk_write = collection_type.bulk_write
+    failures = []
+
+    def flaky_bulk_write(self, operations, **kwargs):
+        if self.name == 'event' and len(failures) < 2:
+            failures.append(operations)
+            if len(failures) == 1:
+                # The write reaches the database, but the reply is lost.
+                bulk_write(self, operations, **kwargs)
+            raise pymongo.errors.AutoReconnect("Lost the connection.")
+        return bulk_write(self, operations, **kwargs)
+
+    monkeypatch.setattr(collection_type, 'bulk_write', flaky_bulk_write)
+    journaled_run(serializer)
+    assert serializer.retries == {'event': 2, 'datum': 0}
+    events = [event for page in permanent_db.event.find()
+              for event in event_model.unpack_event_page(page)]
+    assert [event['seq_num'] for event in events] == list(range(1, 13))
+
+
+def test_bulk_write_retries_exhausted(db_factory, monkeypatch):
+    """
+    Test that a write that keeps failing is reported after max_retries.
+    """
+    permanent_db = db_factory()
+    serializer = Serializer(permanent_db, max_retries=2, retry_backoff=0.01)
+    collection_type = type(permanent_db.event)
+    bulk_write = collection_type.bulk_write
+
+    def failing_bulk_write(self, operations, **kwargs):
+        if self.name == 'event':
+            raise pymongo.errors.AutoReconnect("Lost the connection.")
+        return bulk_write(self, operations, **kwargs)
+
+    monkeypatch.setattr(collection_type, 'bulk_write', failing_bulk_write)
+    with pytest.raises(RuntimeError):
+        try:
+            journaled_run(serializer)
+        finally:
+            serializer.close()
+    assert serializer.retries == {'event': 2, 'datum': 0}
+
+
+def test_pages_written_by_workers(db_factory, example_data):
+    """
+    Test that event_pages and datum_pages are not written on the caller's
+    thread.
+    """
+    permanent_db = db_factory()
+    serializer = Serializer(permanent_db)
+    threads = set()
+
+    def wrap(bulkwrite):
+        def inner(*args, **kwargs):
+            threads.add(threading.current_thread())
+            return bulkwrite(*args, **kwargs)
+        return inner
+
+    serializer._bulkwrite_event = wrap(serializer._bulkwrite_event)
+    serializer._bulkwrite_datum = wrap(serializer._bulkwrite_datum)
+    run(example_data, serializer, permanent_db)
+    assert threading.current_thread() not in threads
+
+
+def test_split_large_page(db_factory):
+    """
+    Test that an event_page larger than the embedder is split.
+    """
+    permanent_db = db_factory()
+    serializer = Serializer(permanent_db, embedder_size=5000,
+                            page_size=5000)
+    run_bundle = event_model.compose_run()
+    serializer('start', run_bundle.start_doc)
+    descriptor_bundle = run_bundle.compose_descriptor(
+        name='primary',
+        data_keys={'x': {'source': 'x', 'dtype': 'number', 'shape': []}})
+    serializer('descriptor', descriptor_bundle.descriptor_doc)
+    event_page = descriptor_bundle.compose_event_page(
+        data={'x': list(range(1000))},
+        timestamps={'x': [time.time()] * 1000},
+        seq_num=list(range(1, 1001)))
+    serializer('event_page', event_page)
+    serializer('stop', run_bundle.compose_stop())
+
+    pages = list(permanent_db.event.find({}, {'_id': False}))
+    assert len(pages) > 1
+    assert all(page['size'] < 5000 * 2 for page in pages)
+    pages.sort(key=lambda page: page['first_index'])
+    assert pages[0]['first_index'] == 0
+    assert pages[-1]['last_index'] == 999
+    for previous, page in zip(pages, pages[1:]):
+        assert page['first_index'] == previous['last_index'] + 1
+    assert sum((page['seq_num'] for page in pages), []) == list(range(1, 1001))
+
+
+def test_header_id(db_factory, example_data):
+    """
+    Test that the header is indexed by run_id and that its _id is cached.
+    """
+    permanent_db = db_factory()
+    serializer = Serializer(permanent_db)
+    assert permanent_db.header.index_information()['run_id_1']['unique']
+    run(example_data, serializer, permanent_db)
+    header = permanent_db.header.find_one({'run_id': serializer._run_uid})
+    assert serializer._header_id == header['_id']
+
+
+def test_open_pages(db_factory, example_data):
+    """
+    Test that each stream has at most one page that is not full.
+    """
+    permanent_db = db_factory()
+    serializer = Serializer(permanent_db, page_size=3000, embedder_size=3000)
+    run(example_data, serializer, permanent_db)
+    for stream_key in ('descriptor', 'resource'):
+        collection = (permanent_db.event if stream_key == 'descriptor'
+                      else permanent_db.datum)
+        open_pages = defaultdict(int)
+        for page in collection.find({'size': {'$lt': 3000}}):
+            open_pages[page[stream_key]] += 1
+        assert all(count == 1 for count in open_pages.values())
+
+
 def test_evil_db(db_factory, example_data):
     """
     Test suitcase-mongo-embedded serializer with a db that raises an exception
@@ -73,10 +604,93 @@ def test_evil_db(db_factory, example_data):
     serializer = Serializer(permanent_db)
     serializer._bulkwrite_event = evil_func
     serializer._bulkwrite_datum = evil_func
+    # The error is raised by the next document, or by close() if it happens
+    # after the last one.
     with pytest.raises(RuntimeError):
-        run(example_data, serializer, permanent_db)
-    if not serializer._frozen:
-        serializer.close()
+        try:
+            run(example_data, serializer, permanent_db)
+        finally:
+            if not serializer._frozen:
+                serializer.close()
+
+
+def test_embedder_columns():
+    """
+    Test that the Embedder's columns round-trip values of every type.
+    """
+    embedder = Embedder('event', 100000)
+    values = [
+        ('int', [1, 2, 3]),
+        ('float', [1.5, 2.5, 3.5]),
+        ('mixed', [1, 2.5, 'three']),
+        ('bool', [True, False, True]),
+        ('array', [[1, 2], [3, 4], [5, 6]]),
+    ]
+    for i in range(3):
+        assert embedder.insert({
+            'descriptor': 'descriptor-uid', 'uid': f'uid-{i}', 'seq_num': i + 1,
+            'time': float(i),
+            'data': {key: column[i] for key, column in values},
+            'timestamps': {key: float(i) for key, _ in values},
+            'filled': {}}) is None
+    dump, sizes = embedder.dump()
+    assert embedder.empty()
+    page = dump['descriptor-uid']
+    assert sizes['descriptor-uid'] > 0
+    assert page['uid'] == ['uid-0', 'uid-1', 'uid-2']
+    assert page['seq_num'] == [1, 2, 3]
+    assert page['time'] == [0.0, 1.0, 2.0]
+    assert page['filled'] == {}
+    for key, column in values:
+        assert page['data'][key] == column
+        assert [type(value) for value in page['data'][key]] == [
+            type(value) for value in column]
+
+
+def test_embedder_describe():
+    """
+    Test that described streams embed the same pages as undescribed ones.
+    """
+    data_keys = {'x': {'source': 'x', 'dtype': 'number', 'shape': []},
+                 'img': {'source': 'img', 'dtype': 'array', 'shape': [2],
+                         'external': 'FILESTORE:'}}
+    events = [{'descriptor': 'descriptor-uid', 'uid': f'uid-{i}',
+               'seq_num': i + 1, 'time': float(i),
+               'data': {'x': float(i), 'img': f'datum-{i}'},
+               'timestamps': {'x': float(i), 'img': float(i)},
+               'filled': {'img': False}}
+              for i in range(3)]
+    # An event with an extra data key does not fit the layout.
+    events[2]['data']['y'] = 1
+    events[2]['timestamps']['y'] = 2.0
+    described = Embedder('event', 100000)
+    described.describe({'uid': 'descriptor-uid', 'data_keys': data_keys})
+    undescribed = Embedder('event', 100000)
+    for event in events:
+        assert described.insert(event) is None
+        assert undescribed.insert(event) is None
+    assert described.dump() == undescribed.dump()
+    described.forget('descriptor-uid')
+    assert not described._layouts
+
+
+@pytest.mark.parametrize('doc', [
+    {},
+    {'float': 1.5, 'int': 1, 'int64': 2 ** 40, 'bool': True, 'none': None,
+     'str': 'abc', 'unicode': 'åbç', 'ünicode_key': 1},
+    {'floats': [float(i) for i in range(1000)],
+     'ints': list(range(100)), 'int64s': [1, 2 ** 40],
+     'strs': ['a', 'bb', 'ççç'], 'tuple': (1, 2.5),
+     'mixed': [1, 'a', None, [1, 2], {'a': 1}, []],
+     'image': [[i * j for i in range(20)] for j in range(20)]},
+    {'nested': {'dict': {'a': [1.5, 2.5]}}, 'empty': {},
+     'datetime': datetime.datetime(2020, 1, 1)},
+])
+def test_bson_size(doc):
+    """
+    Test that the BSON size estimate is exact.
+    """
+    assert _bson_size(doc) == len(bson.encode(doc))
 
 
 def run(example_data, serializer, permanent_db):
@@ -152,8 +766,10 @@ def run_list_to_dict(embedded_run_list):
 
     for name, doc in embedded_run_list[1:]:
         if name == 'event':
+            doc = event_model.sanitize_doc(decode_event_page(doc))
             run_dict['event'] += list(event_model.unpack_event_page(doc))
         elif name == 'datum':
+            doc = decode_datum_page(doc)
             run_dict['datum'] += list(event_model.unpack_datum_page(doc))
 
     return run_dict
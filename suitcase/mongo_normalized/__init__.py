@@ -1,5 +1,13 @@
+import bson
+from bson.raw_bson import RawBSONDocument
+from concurrent.futures import ThreadPoolExecutor
 import event_model
+import itertools
 import pymongo
+import queue
+from suitcase.mongo_utils import (
+    NUMPY_CODEC_OPTIONS, contains_numpy, ensure_indexes, get_database,
+    has_numpy_codec, with_numpy_codec)
 from ._version import get_versions
 
 __version__ = get_versions()['version']
@@ -8,7 +16,10 @@ del get_versions
 
 class Serializer(event_model.DocumentRouter):
     def __init__(self, metadatastore_db, asset_registry_db,
-                 ignore_duplicates=True, resource_uid_unique=False):
+                 ignore_duplicates=True, resource_uid_unique=False,
+                 insert_batch_size=5000, insert_batch_bytes=10000000,
+                 write_behind=False, num_threads=1, queue_size=10000,
+                 create_indexes=True, verify_indexes=False):
         """
         Insert documents into MongoDB using layout v1.
 
@@ -22,6 +33,8 @@ class Serializer(event_model.DocumentRouter):
         Parameters
         ----------
         metadatastore_db : pymongo.Database or URI
+            MongoClients created for URIs are shared with other Serializers,
+            see ``suitcase.mongo_utils.get_client``.
         asset_registry_db : pymongo.Database or URI
         ignore_duplicates : boolean, optional
             When receiving from a message bus, it is difficult to ensure that
@@ -36,15 +49,60 @@ class Serializer(event_model.DocumentRouter):
             that violate uniqueness of Resource uid are migrated, this may be
             flipped to True. For now, it is False by default and generally
             should not be flipped to True until those conditions are met.
+        insert_batch_size : int, optional
+            Maximum number of documents sent in one ``insert_many`` call when
+            writing the contents of an EventPage or DatumPage. Default is
+            5000.
+        insert_batch_bytes : int, optional
+            Approximate maximum number of bytes sent in one ``insert_many``
+            call when writing the contents of an EventPage or DatumPage. The
+            size of each
+            batch is estimated from the first document in the page. Default
+            is 10000000.
+        write_behind : boolean, optional
+            If True, documents are put on a bounded queue and written by
+            background worker threads, which coalesce Events and Datum into
+            bulk writes. Errors raised by the workers are re-raised on the
+            next call. Use ``flush()`` to wait for the queued documents to be
+            written and ``close()`` to drain the queue and stop the workers.
+            Default is False.
+        num_threads : int, optional
+            Number of worker threads used when ``write_behind`` is True.
+            Default is 1.
+        queue_size : int, optional
+            Maximum number of documents waiting in the queue when
+            ``write_behind`` is True. Default is 10000.
+        create_indexes : boolean, optional
+            If False, assume that the indexes already exist and do not create
+            them, e.g. because they were built ahead of time with
+            ``suitcase-mongo-indexes build``. Default is True.
+        verify_indexes : boolean, optional
+            Indexes are created once per process for each database and
+            collection, later Serializers skip creating them. If this is set
+            to True, the first Serializer instead reads the existing indexes
+            with ``index_information()`` and only creates the missing ones.
+            Default is False.
         """
+        if insert_batch_size < 1:
+            raise ValueError("insert_batch_size must be >= 1")
+        if insert_batch_bytes < 1:
+            raise ValueError("insert_batch_bytes must be >= 1")
+        if num_threads < 1:
+            raise ValueError("num_threads must be >= 1")
         if isinstance(metadatastore_db, str):
-            mds_db = _get_database(metadatastore_db)
+            mds_db = get_database(metadatastore_db)
         else:
             mds_db = metadatastore_db
         if isinstance(asset_registry_db, str):
-            assets_db = _get_database(asset_registry_db)
+            assets_db = get_database(asset_registry_db)
         else:
             assets_db = asset_registry_db
+        # Encode numpy objects as documents are written, rather than
+        # sanitizing every document ahead of time.
+        mds_db = with_numpy_codec(mds_db)
+        assets_db = with_numpy_codec(assets_db)
+        self._numpy_codec = (has_numpy_codec(mds_db)
+                             and has_numpy_codec(assets_db))
         self._run_start_collection = mds_db.get_collection('run_start')
         self._run_start_collection_revisions = mds_db.get_collection('run_start_revisions')
         self._run_stop_collection = mds_db.get_collection('run_stop')
@@ -66,51 +124,148 @@ class Serializer(event_model.DocumentRouter):
         self._asset_registry_db = assets_db
         self._ignore_duplicates = ignore_duplicates
         self._resource_uid_unique = resource_uid_unique
-        self._create_indexes()
+        self._insert_batch_size = insert_batch_size
+        self._insert_batch_bytes = insert_batch_bytes
+        self._verify_indexes = verify_indexes
+        if create_indexes:
+            self._create_indexes()
+
+        self._write_behind = write_behind
+        self._worker_error = None
+        self._closed = False
+        if write_behind:
+            self._num_threads = num_threads
+            self._queue = queue.Queue(maxsize=queue_size)
+            self._executor = ThreadPoolExecutor(max_workers=num_threads)
+            for _ in range(num_threads):
+                self._executor.submit(self._write_behind_worker)
 
     def _create_indexes(self):
         """
         Create indexes on the various collections.
 
-        If the index already exists, this has no effect.
-        """
-        self._resource_collection.create_index(
-            'uid', unique=self._resource_uid_unique)
-        self._resource_collection.create_index('resource_id')  # legacy
-        # TODO: Migrate all Resources to have a RunStart UID, and then make a
-        # unique index on:
-        # [('uid', pymongo.ASCENDING), ('run_start', pymongo.ASCENDING)]
-        self._datum_collection.create_index('datum_id', unique=True)
-        self._datum_collection.create_index('resource')
-        self._run_start_collection.create_index('uid', unique=True)
-        self._run_start_collection.create_index(
-            [('time', pymongo.DESCENDING), ('scan_id', pymongo.DESCENDING)],
-            unique=False, background=True)
-        self._run_start_collection.create_index([("$**", "text")])
-        self._run_start_collection.create_index('data_session', unique=False)
-        self._run_start_collection.create_index('data_groups', unique=False)
-        self._run_stop_collection.create_index('run_start', unique=True)
-        self._run_stop_collection.create_index('uid', unique=True)
-        self._run_stop_collection.create_index(
-            [('time', pymongo.DESCENDING)], unique=False, background=True)
-        self._run_stop_collection.create_index([("$**", "text")])
-        self._event_descriptor_collection.create_index('uid', unique=True)
-        self._event_descriptor_collection.create_index(
-            [('run_start', pymongo.DESCENDING), ('time', pymongo.DESCENDING)],
-            unique=False, background=True)
-        self._event_descriptor_collection.create_index(
-            [('time', pymongo.DESCENDING)], unique=False, background=True)
-        self._event_descriptor_collection.create_index([("$**", "text")])
-        self._event_collection.create_index('uid', unique=True)
-        self._event_collection.create_index(
-            [('descriptor', pymongo.DESCENDING), ('time', pymongo.ASCENDING)],
-            unique=False, background=True)
+        If the index already exists, this has no effect. Index sets that this
+        process has already ensured are skipped without a round trip.
+        """
+        databases = {'metadatastore': self._metadatastore_db,
+                     'asset_registry': self._asset_registry_db}
+        for (database, collection), indexes in _indexes(
+                self._resource_uid_unique).items():
+            ensure_indexes(databases[database].get_collection(collection),
+                           indexes, verify=self._verify_indexes)
 
     def __call__(self, name, doc):
-        # Before inserting into mongo, convert any numpy objects into built-in
-        # Python types compatible with pymongo.
-        sanitized_doc = event_model.sanitize_doc(doc)
-        return super().__call__(name, sanitized_doc)
+        """
+        Insert a document.
+
+        doc may be a ``bson.raw_bson.RawBSONDocument``, e.g. a document that
+        was received already encoded as BSON. It is not sanitized, and Run
+        Start, Run Stop, Event Descriptor, Event and Datum documents are
+        inserted as they are, without being encoded again.
+        """
+        if isinstance(doc, RawBSONDocument):
+            # BSON holds no numpy objects.
+            sanitized_doc = doc if name in _RAW_INSERTS else _to_dict(doc)
+        elif self._numpy_codec or not contains_numpy(doc):
+            # The collections encode numpy objects themselves. pymongo adds
+            # an _id to the documents it inserts, so the caller's document
+            # is copied, but only shallowly.
+            sanitized_doc = dict(doc)
+        else:
+            # Before inserting into mongo, convert any numpy objects into
+            # built-in Python types compatible with pymongo.
+            sanitized_doc = event_model.sanitize_doc(doc)
+        if not self._write_behind:
+            return super().__call__(name, sanitized_doc)
+        if self._worker_error:
+            raise RuntimeError("Worker exception: ") from self._worker_error
+        if self._closed:
+            raise RuntimeError("Cannot insert documents into "
+                               "closed Serializer.")
+        if name == 'stop':
+            # Everything from the run must be in the database before the
+            # stop document is.
+            self.flush()
+            return super().__call__(name, sanitized_doc)
+        self._queue.put((name, sanitized_doc))
+        return name, doc
+
+    def _write_behind_worker(self):
+        # Gets documents from the queue and writes them to the database,
+        # coalescing Events and Datum into bulk writes. None is the signal
+        # for the worker to finish.
+        while True:
+            items = [self._queue.get()]
+            # Take whatever else is already waiting, up to one batch.
+            while items[-1] is not None and len(items) < self._insert_batch_size:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                if self._worker_error is None:
+                    self._write_items([item for item in items if item is not None])
+            except Exception as error:
+                # Keep consuming the queue so that flush() and close() do not
+                # block; the error is re-raised on the caller's thread.
+                self._worker_error = error
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+            if items[-1] is None:
+                return
+
+    def _write_items(self, items):
+        """
+        Write a list of queued (name, doc) pairs, coalescing Events and Datum.
+        """
+        events = []
+        datum = []
+        for name, doc in items:
+            if name == 'event':
+                events.append(doc)
+            elif name == 'event_page':
+                events.extend(event_model.unpack_event_page(doc))
+            elif name == 'datum':
+                datum.append(doc)
+            elif name == 'datum_page':
+                datum.extend(event_model.unpack_datum_page(doc))
+            else:
+                super().__call__(name, doc)
+        self._insert_many('datum', datum)
+        self._insert_many('event', events)
+
+    def flush(self):
+        """
+        Block until all queued documents have been written.
+
+        This has no effect unless ``write_behind`` is True.
+        """
+        if self._write_behind:
+            self._queue.join()
+            if self._worker_error:
+                raise RuntimeError("Worker exception: ") from self._worker_error
+
+    def close(self):
+        """
+        Write all queued documents and stop the worker threads.
+
+        This has no effect unless ``write_behind`` is True.
+        """
+        if not self._write_behind or self._closed:
+            return
+        self._closed = True
+        for _ in range(self._num_threads):
+            self._queue.put(None)
+        self._executor.shutdown(wait=True)
+        if self._worker_error:
+            raise RuntimeError("Worker exception: ") from self._worker_error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_details):
+        self.close()
 
     def _insert(self, name, doc):
         try:
@@ -122,8 +277,9 @@ class Serializer(event_model.DocumentRouter):
                     f"already exists in the database. Document:\n{doc}"
                 ) from err
             else:
-                doc.pop('_id')
-                existing = self._collections[name].find_one({'uid': doc['uid']}, {'_id': False})
+                doc = _comparable(doc)
+                key = _UNIQUE_KEYS.get(name, 'uid')
+                existing = self._collections[name].find_one({key: doc[key]}, {'_id': False})
                 if existing != doc:
                     raise DuplicateUniqueID(
                         "A document with the same unique id as this one "
@@ -132,6 +288,73 @@ class Serializer(event_model.DocumentRouter):
                         f"Existing document:\n{existing}\nNew document:\n{doc}"
                     ) from err
 
+    def _insert_many(self, name, docs):
+        """
+        Insert an iterable of documents using unordered ``insert_many`` calls.
+
+        The documents are sent in batches bounded by ``insert_batch_size``
+        documents and (approximately) ``insert_batch_bytes`` bytes. Duplicates
+        are handled per batch with the same semantics as ``_insert``.
+        """
+        docs = iter(docs)
+        first = next(docs, None)
+        if first is None:
+            return
+        # Documents unpacked from one page have the same structure, so the
+        # size of the first one is a good estimate for the rest.
+        doc_size = len(bson.encode(first, codec_options=NUMPY_CODEC_OPTIONS))
+        batch_size = max(1, min(self._insert_batch_size,
+                                self._insert_batch_bytes // doc_size))
+        docs = itertools.chain([first], docs)
+        while True:
+            batch = list(itertools.islice(docs, batch_size))
+            if not batch:
+                break
+            try:
+                self._collections[name].insert_many(batch, ordered=False)
+            except pymongo.errors.BulkWriteError as err:
+                self._handle_bulk_write_error(name, batch, err)
+
+    def _handle_bulk_write_error(self, name, batch, err):
+        """
+        Check the duplicate key errors in a failed ``insert_many`` batch.
+
+        Any error other than a duplicate key error is re-raised.
+        """
+        write_errors = err.details.get('writeErrors', [])
+        if any(error['code'] != 11000 for error in write_errors):
+            raise err
+        if not self._ignore_duplicates:
+            duplicates = [batch[error['index']] for error in write_errors]
+            raise DuplicateUniqueID(
+                "Documents with the same unique id as these ones "
+                f"already exist in the database. Documents:\n{duplicates}"
+            ) from err
+        self._verify_duplicates(
+            name, [batch[error['index']] for error in write_errors], err)
+
+    def _verify_duplicates(self, name, duplicates, err):
+        """
+        Check that colliding documents match the copies already stored.
+
+        The stored copies are fetched with a single ``$in`` query and
+        compared in memory, rather than with one ``find_one`` per document.
+        """
+        key = _UNIQUE_KEYS.get(name, 'uid')
+        duplicates = [_comparable(doc) for doc in duplicates]
+        cursor = self._collections[name].find(
+            {key: {'$in': [doc[key] for doc in duplicates]}}, {'_id': False})
+        existing_docs = {existing[key]: existing for existing in cursor}
+        for doc in duplicates:
+            existing = existing_docs.get(doc[key])
+            if existing != doc:
+                raise DuplicateUniqueID(
+                    "A document with the same unique id as this one "
+                    "already exists in the database, and it has different "
+                    "contents.\n"
+                    f"Existing document:\n{existing}\nNew document:\n{doc}"
+                ) from err
+
     def update(self, name, doc):
         """
         Update documents. Currently only 'start' documents are supported.
@@ -149,6 +372,8 @@ class Serializer(event_model.DocumentRouter):
             The new version of the document. Its uid will be used to match it
             to the current version, the one to be updated.
         """
+        # The document being updated may still be waiting in the queue.
+        self.flush()
         if name == 'start':
             event_model.schema_validators[event_model.DocumentNames.start].validate(doc)
             current_col = self._run_start_collection
@@ -189,7 +414,7 @@ class Serializer(event_model.DocumentRouter):
         else:
             existing = self._collections["resource"].find_one({'uid': doc['uid']}, {'_id': False})
             if existing is not None:
-                if existing != doc:
+                if existing != _comparable(doc):
                     raise DuplicateUniqueID(
                         "A document with the same unique id as this one "
                         "already exists in the database, and it has different "
@@ -202,29 +427,17 @@ class Serializer(event_model.DocumentRouter):
         self._insert('event', doc)
 
     def event_page(self, doc):
-        # Unpack an EventPage into Events and do the actual insert inside
-        # the `event` method. (This is the oppose what DocumentRouter does by
-        # default.)
-
-        event_method = self.event  # Avoid attribute lookup in hot loop.
-        filled_events = []
-
-        for event_doc in event_model.unpack_event_page(doc):
-            filled_events.append(event_method(event_doc))
+        # Unpack an EventPage into Events and insert them in batches with
+        # insert_many, rather than one round trip per Event.
+        self._insert_many('event', event_model.unpack_event_page(doc))
 
     def datum(self, doc):
         self._insert('datum', doc)
 
     def datum_page(self, doc):
-        # Unpack an DatumPage into Datum and do the actual insert inside
-        # the `datum` method. (This is the oppose what DocumentRouter does by
-        # default.)
-
-        datum_method = self.datum  # Avoid attribute lookup in hot loop.
-        filled_datums = []
-
-        for datum_doc in event_model.unpack_datum_page(doc):
-            filled_datums.append(datum_method(datum_doc))
+        # Unpack a DatumPage into Datum and insert them in batches with
+        # insert_many, rather than one round trip per Datum.
+        self._insert_many('datum', event_model.unpack_datum_page(doc))
 
     def stop(self, doc):
         self._insert('stop', doc)
@@ -236,14 +449,81 @@ class Serializer(event_model.DocumentRouter):
                 f'asset_registry_db={self._asset_registry_db!r})')
 
 
-def _get_database(uri):
-    if not pymongo.uri_parser.parse_uri(uri)['database']:
-        raise ValueError(
-            f"Invalid URI: {uri} "
-            f"Did you forget to include a database?")
-    else:
-        client = pymongo.MongoClient(uri)
-        return client.get_database()
+def _indexes(resource_uid_unique=False):
+    """
+    Returns the indexes of this layout.
+
+    The indexes are given as a dict that maps (database, collection) pairs,
+    where database is 'metadatastore' or 'asset_registry', to lists of
+    (keys, options) pairs.
+    """
+    ASCENDING = pymongo.ASCENDING
+    DESCENDING = pymongo.DESCENDING
+    return {
+        ('asset_registry', 'resource'): [
+            ([('uid', ASCENDING)], {'unique': resource_uid_unique}),
+            ([('resource_id', ASCENDING)], {}),  # legacy
+            # TODO: Migrate all Resources to have a RunStart UID, and then
+            # make a unique index on:
+            # [('uid', pymongo.ASCENDING), ('run_start', pymongo.ASCENDING)]
+        ],
+        ('asset_registry', 'datum'): [
+            ([('datum_id', ASCENDING)], {'unique': True}),
+            ([('resource', ASCENDING)], {}),
+        ],
+        ('metadatastore', 'run_start'): [
+            ([('uid', ASCENDING)], {'unique': True}),
+            ([('time', DESCENDING), ('scan_id', DESCENDING)],
+             {'unique': False, 'background': True}),
+            ([('$**', 'text')], {}),
+            ([('data_session', ASCENDING)], {'unique': False}),
+            ([('data_groups', ASCENDING)], {'unique': False}),
+        ],
+        ('metadatastore', 'run_stop'): [
+            ([('run_start', ASCENDING)], {'unique': True}),
+            ([('uid', ASCENDING)], {'unique': True}),
+            ([('time', DESCENDING)], {'unique': False, 'background': True}),
+            ([('$**', 'text')], {}),
+        ],
+        ('metadatastore', 'event_descriptor'): [
+            ([('uid', ASCENDING)], {'unique': True}),
+            ([('run_start', DESCENDING), ('time', DESCENDING)],
+             {'unique': False, 'background': True}),
+            ([('time', DESCENDING)], {'unique': False, 'background': True}),
+            ([('$**', 'text')], {}),
+        ],
+        ('metadatastore', 'event'): [
+            ([('uid', ASCENDING)], {'unique': True}),
+            ([('descriptor', DESCENDING), ('time', ASCENDING)],
+             {'unique': False, 'background': True}),
+        ],
+    }
+
+
+# Datum are identified by datum_id; every other document type by uid.
+_UNIQUE_KEYS = {'datum': 'datum_id'}
+
+# Pre-encoded documents that are inserted without being decoded. Resources
+# are compared with the stored copy first, and pages are unpacked.
+_RAW_INSERTS = {'start', 'descriptor', 'event', 'datum', 'stop'}
+
+
+def _to_dict(doc):
+    """
+    Decodes a RawBSONDocument. Other documents are returned as they are.
+    """
+    if isinstance(doc, RawBSONDocument):
+        return bson.decode(doc.raw)
+    return doc
+
+
+def _comparable(doc):
+    """
+    Returns a document as it reads back from the database, without its _id.
+    """
+    doc = dict(_to_dict(doc))
+    doc.pop('_id', None)
+    return event_model.sanitize_doc(doc)
 
 
 class DuplicateUniqueID(Exception):
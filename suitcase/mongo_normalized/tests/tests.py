@@ -2,6 +2,7 @@
 # binary files should be included in the repository.
 
 import copy
+import event_model
 import pytest
 from event_model import sanitize_doc
 from jsonschema import ValidationError
@@ -140,3 +141,168 @@ def test_resource_uid_unique(db_factory):
 
     indexes = asset_registry_db.resource.index_information()
     assert indexes['uid_1'].get('unique')
+
+
+def test_event_page_batches(db_factory, example_data):
+    documents = example_data()
+    metadatastore_db = db_factory()
+    asset_registry_db = db_factory()
+    serializer = Serializer(metadatastore_db, asset_registry_db,
+                            insert_batch_size=2)
+    calls = []
+    insert_many = serializer._event_collection.insert_many
+
+    def counting_insert_many(docs, *args, **kwargs):
+        calls.append(len(docs))
+        return insert_many(docs, *args, **kwargs)
+
+    serializer._event_collection.insert_many = counting_insert_many
+    single_events = 0
+    for name, doc in documents:
+        serializer(name, doc)
+        if name == 'event':
+            single_events += 1
+    assert all(length <= 2 for length in calls)
+    assert sum(calls) == (metadatastore_db.event.count_documents({})
+                          - single_events)
+
+
+def test_event_page_duplicates_raise(db_factory):
+    metadatastore_db = db_factory()
+    asset_registry_db = db_factory()
+    serializer = Serializer(metadatastore_db, asset_registry_db,
+                            ignore_duplicates=False)
+    run_bundle = event_model.compose_run()
+    serializer('start', run_bundle.start_doc)
+    descriptor_bundle = run_bundle.compose_descriptor(
+        name='primary',
+        data_keys={'x': {'source': 'x', 'dtype': 'number', 'shape': []}})
+    serializer('descriptor', descriptor_bundle.descriptor_doc)
+    event_page = descriptor_bundle.compose_event_page(
+        data={'x': [1.0, 2.0, 3.0]}, timestamps={'x': [0.0, 0.0, 0.0]},
+        seq_num=[1, 2, 3])
+    serializer('event_page', event_page)
+    assert metadatastore_db.event.count_documents({}) == 3
+    with pytest.raises(DuplicateUniqueID):
+        serializer('event_page', event_page)
+
+
+def test_datum_page_duplicates(db_factory):
+    metadatastore_db = db_factory()
+    asset_registry_db = db_factory()
+    serializer = Serializer(metadatastore_db, asset_registry_db,
+                            insert_batch_size=2)
+    datum_page = {'resource': 'resource-uid',
+                  'datum_id': [f'resource-uid/{i}' for i in range(5)],
+                  'datum_kwargs': {'index': list(range(5))}}
+    serializer('datum_page', datum_page)
+    assert asset_registry_db.datum.count_documents({}) == 5
+
+    # Replaying an identical page is ignored.
+    serializer('datum_page', datum_page)
+    assert asset_registry_db.datum.count_documents({}) == 5
+
+    # Replaying a page with different contents raises.
+    datum_page['datum_kwargs']['index'][3] = 100
+    with pytest.raises(DuplicateUniqueID):
+        serializer('datum_page', datum_page)
+
+
+def test_duplicate_verification_queries(db_factory):
+    metadatastore_db = db_factory()
+    asset_registry_db = db_factory()
+    serializer = Serializer(metadatastore_db, asset_registry_db)
+    datum_page = {'resource': 'resource-uid',
+                  'datum_id': [f'resource-uid/{i}' for i in range(100)],
+                  'datum_kwargs': {'index': list(range(100))}}
+    serializer('datum_page', datum_page)
+
+    # A replayed page is verified with one query per batch, not per document.
+    calls = []
+    find = serializer._datum_collection.find
+    find_one = serializer._datum_collection.find_one
+
+    def counting_find(*args, **kwargs):
+        calls.append(args)
+        return find(*args, **kwargs)
+
+    def counting_find_one(*args, **kwargs):
+        calls.append(args)
+        return find_one(*args, **kwargs)
+
+    serializer._datum_collection.find = counting_find
+    serializer._datum_collection.find_one = counting_find_one
+    serializer('datum_page', datum_page)
+    assert len(calls) == 1
+
+
+def test_write_behind(db_factory, example_data):
+    documents = example_data()
+    metadatastore_db = db_factory()
+    asset_registry_db = db_factory()
+    expected_metadatastore_db = db_factory()
+    expected_asset_registry_db = db_factory()
+    serializer = Serializer(metadatastore_db, asset_registry_db,
+                            write_behind=True, num_threads=2)
+    expected_serializer = Serializer(expected_metadatastore_db,
+                                     expected_asset_registry_db)
+    with serializer:
+        for item in documents:
+            serializer(*item)
+            expected_serializer(*item)
+    for db, expected_db in [(metadatastore_db, expected_metadatastore_db),
+                            (asset_registry_db, expected_asset_registry_db)]:
+        for name in expected_db.list_collection_names():
+            expected = sorted(expected_db[name].find({}, {'_id': False}),
+                              key=repr)
+            actual = sorted(db[name].find({}, {'_id': False}), key=repr)
+            assert actual == expected
+
+
+def test_write_behind_error(db_factory, example_data):
+    documents = example_data()
+    metadatastore_db = db_factory()
+    asset_registry_db = db_factory()
+    serializer = Serializer(metadatastore_db, asset_registry_db,
+                            write_behind=True)
+
+    def evil_func(*args, **kwargs):
+        raise ValueError
+
+    serializer._write_items = evil_func
+    serializer(*documents[0])
+    with pytest.raises(RuntimeError):
+        serializer.flush()
+    with pytest.raises(RuntimeError):
+        serializer(*documents[1])
+    with pytest.raises(RuntimeError):
+        serializer.close()
+
+
+def test_raw_bson(db_factory, example_data):
+    """
+    Test that pre-encoded documents are inserted like the documents they
+    encode, including duplicates.
+    """
+    import bson
+    from bson.raw_bson import RawBSONDocument
+    import mongomock
+
+    documents = example_data()
+    metadatastore_db = db_factory()
+    if isinstance(metadatastore_db.client, mongomock.MongoClient):
+        pytest.skip("mongomock cannot insert RawBSONDocuments")
+    asset_registry_db = db_factory()
+    serializer = Serializer(metadatastore_db, asset_registry_db)
+    for _ in range(2):
+        for name, doc in documents:
+            serializer(name, RawBSONDocument(bson.encode(sanitize_doc(doc))))
+    start = sanitize_doc(documents[0][1])
+    assert metadatastore_db.run_start.find_one(
+        {'uid': start['uid']}, {'_id': False}) == start
+    expected = Serializer(db_factory(), db_factory())
+    for name, doc in documents:
+        expected(name, doc)
+    for collection in ('event', 'event_descriptor', 'run_stop'):
+        assert (metadatastore_db[collection].count_documents({})
+                == expected._metadatastore_db[collection].count_documents({}))
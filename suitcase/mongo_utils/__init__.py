@@ -0,0 +1,232 @@
+"""
+Helpers shared by the suitcase.mongo_normalized and suitcase.mongo_embedded
+layouts.
+"""
+import atexit
+import threading
+
+from bson.codec_options import CodecOptions, TypeRegistry
+import pymongo
+
+# Maps normalized connection strings to the MongoClients shared by every
+# Serializer that was given a URI.
+_clients = {}
+_clients_lock = threading.Lock()
+
+# Maps (client address, database name, collection name) to the set of index
+# specs that have already been ensured on that collection by this process.
+_ensured_indexes = {}
+_ensured_indexes_lock = threading.Lock()
+
+
+def get_client(uri, **kwargs):
+    """
+    Returns a MongoClient for a URI, shared with every other caller.
+
+    Each MongoClient has its own connection pool and monitoring threads, so
+    one client is kept per deployment, credentials and options. URIs that
+    differ only in the order of their hosts or options, in the database they
+    name, or in whether an option is given in the URI or as a keyword
+    argument, share a client.
+
+    Parameters
+    ----------
+    uri: str
+        MongoDB URI.
+    **kwargs
+        Options for the MongoClient, such as ``maxPoolSize``, which sets the
+        maximum size of its connection pool.
+    """
+    parsed = pymongo.uri_parser.parse_uri(uri)
+    options = {key.lower(): value for key, value in parsed['options'].items()}
+    options.update((key.lower(), value) for key, value in kwargs.items())
+    key = (tuple(sorted(parsed['nodelist'])), parsed['username'],
+           parsed['password'],
+           tuple(sorted((name, repr(value))
+                        for name, value in options.items())))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = pymongo.MongoClient(uri, **kwargs)
+        return client
+
+
+def get_database(uri, **kwargs):
+    """
+    Returns the database named in a URI, using a shared MongoClient.
+
+    Parameters
+    ----------
+    uri: str
+        MongoDB URI, including a database name.
+    **kwargs
+        Options for the MongoClient, see ``get_client``.
+    """
+    if not pymongo.uri_parser.parse_uri(uri)['database']:
+        raise ValueError(
+            f"Invalid URI: {uri} "
+            f"Did you forget to include a database?")
+    return get_client(uri, **kwargs).get_database()
+
+
+def close_clients():
+    """
+    Close every shared MongoClient.
+
+    This is registered to run when the interpreter exits, and can be called
+    earlier, e.g. when a service shuts down. Later calls to ``get_client``
+    create new clients.
+    """
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        client.close()
+
+
+atexit.register(close_clients)
+
+
+def encode_numpy(value):
+    """
+    Encodes numpy scalars and arrays as the built-in types that BSON holds.
+
+    This is the fallback encoder of ``NUMPY_CODEC_OPTIONS``, so it is only
+    called for values that BSON cannot encode otherwise. Other values are
+    returned as they are, and the encoder raises for them.
+    """
+    if type(value).__module__ == 'numpy':
+        return value.tolist()
+    return value
+
+
+NUMPY_CODEC_OPTIONS = CodecOptions(
+    type_registry=TypeRegistry(fallback_encoder=encode_numpy))
+
+
+def with_numpy_codec(database):
+    """
+    Returns a database whose collections encode numpy scalars and arrays.
+
+    Documents with numpy objects in them can then be written without being
+    sanitized first. The codec options of mongomock databases cannot hold a
+    type registry, so databases of other clients are returned as they are;
+    ``has_numpy_codec`` tells them apart.
+    """
+    if not isinstance(database.client, pymongo.MongoClient):
+        return database
+    return database.with_options(
+        codec_options=database.codec_options.with_options(
+            type_registry=NUMPY_CODEC_OPTIONS.type_registry))
+
+
+def has_numpy_codec(database):
+    """
+    Returns True if the database encodes numpy scalars and arrays.
+    """
+    codec_options = getattr(database, 'codec_options', None)
+    return (codec_options is not None and
+            codec_options.type_registry == NUMPY_CODEC_OPTIONS.type_registry)
+
+
+def contains_numpy(doc):
+    """
+    Returns True if there are numpy objects anywhere in a document.
+
+    This is much cheaper than ``event_model.sanitize_doc``, which copies the
+    whole document, so documents without numpy objects can skip it.
+    """
+    values = [doc]
+    while values:
+        value = values.pop()
+        if isinstance(value, dict):
+            values.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            values.extend(value)
+        elif type(value).__module__ == 'numpy':
+            return True
+    return False
+
+
+def ensure_indexes(collection, indexes, verify=False):
+    """
+    Create indexes on a collection, unless this process already has.
+
+    Creating an index that already exists has no effect, but still costs a
+    round trip to the database per index. The index sets that have been
+    ensured are recorded per client address, database and collection, so
+    that later calls for the same set skip the round trips entirely.
+
+    Parameters
+    ----------
+    collection: pymongo.collection.Collection
+    indexes: list
+        A list of ``(keys, options)`` pairs, where ``keys`` is a list of
+        ``(field, direction)`` pairs and ``options`` is a dict of keyword
+        arguments for ``create_index``.
+    verify: boolean, optional
+        If True, the first time this index set is ensured the collection's
+        ``index_information()`` is read once and only the indexes that are
+        missing from it are created. Default is False.
+    """
+    key = _collection_key(collection)
+    spec = _freeze(indexes)
+    with _ensured_indexes_lock:
+        if spec in _ensured_indexes.get(key, ()):
+            return
+    if verify:
+        existing = collection.index_information()
+        indexes = [(keys, options) for keys, options in indexes
+                   if index_name(keys) not in existing]
+    for keys, options in indexes:
+        collection.create_index(keys, **options)
+    _mark_ensured(collection, spec)
+
+
+def clear_index_cache(collection=None):
+    """
+    Forget which indexes have been ensured, e.g. after dropping them.
+
+    Parameters
+    ----------
+    collection: pymongo.collection.Collection, optional
+        Only forget the indexes of this collection. By default, the indexes
+        of every collection are forgotten.
+    """
+    with _ensured_indexes_lock:
+        if collection is None:
+            _ensured_indexes.clear()
+        else:
+            _ensured_indexes.pop(_collection_key(collection), None)
+
+
+def index_name(keys):
+    """
+    Returns the name that MongoDB gives by default to an index on keys.
+    """
+    return '_'.join(f'{field}_{direction}' for field, direction in keys)
+
+
+def _mark_ensured(collection, spec):
+    with _ensured_indexes_lock:
+        _ensured_indexes.setdefault(_collection_key(collection),
+                                    set()).add(spec)
+
+
+def _collection_key(collection):
+    database = collection.database
+    return (_client_address(database.client), database.name, collection.name)
+
+
+def _client_address(client):
+    # The addresses known to the topology identify the deployment without a
+    # round trip to the server. Clients that do not have a topology, such as
+    # mongomock's, fall back to their address.
+    if isinstance(client, pymongo.MongoClient):
+        return tuple(sorted(client.topology_description.server_descriptions()))
+    return client.address
+
+
+def _freeze(indexes):
+    return tuple((tuple(keys), tuple(sorted(options.items())))
+                 for keys, options in indexes)
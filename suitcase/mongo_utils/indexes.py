@@ -0,0 +1,222 @@
+"""
+Manage the indexes of the suitcase-mongo layouts ahead of time.
+
+Both Serializers create their indexes when they are constructed. On large
+existing collections, or on a fresh replica, building them can take a long
+time, so they can instead be built, verified, compared or dropped here, and
+the Serializers told not to create them with ``create_indexes=False``.
+
+This module is also available as the ``suitcase-mongo-indexes`` command.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import sys
+import threading
+
+from . import (_freeze, _mark_ensured, clear_index_cache, get_database,
+               index_name)
+
+LAYOUTS = ('normalized', 'embedded')
+
+
+def layout_indexes(layout, db, asset_registry_db=None,
+                   resource_uid_unique=False):
+    """
+    Returns the indexes of a layout.
+
+    Parameters
+    ----------
+    layout: {'normalized', 'embedded'}
+    db: pymongo.database.Database
+        The database of the embedded layout, or the metadatastore database
+        of the normalized layout.
+    asset_registry_db: pymongo.database.Database, optional
+        The asset registry database of the normalized layout. Defaults to
+        ``db``.
+    resource_uid_unique: boolean, optional
+        Whether the normalized layout's index on Resource uid is unique. See
+        ``suitcase.mongo_normalized.Serializer``.
+
+    Returns
+    -------
+    targets: list
+        A list of (collection, indexes) pairs, where indexes is a list of
+        (keys, options) pairs.
+    """
+    if layout == 'normalized':
+        from suitcase.mongo_normalized import _indexes
+        databases = {'metadatastore': db,
+                     'asset_registry': asset_registry_db or db}
+        return [(databases[database].get_collection(collection), indexes)
+                for (database, collection), indexes
+                in _indexes(resource_uid_unique).items()]
+    elif layout == 'embedded':
+        from suitcase.mongo_embedded import _indexes
+        return [(db.get_collection(collection), indexes)
+                for collection, indexes in _indexes().items()]
+    else:
+        raise ValueError(f"Invalid layout {layout}, layout must be one of "
+                         f"{LAYOUTS}")
+
+
+def diff_indexes(targets):
+    """
+    Compare the indexes of a layout with the indexes in the database.
+
+    Parameters
+    ----------
+    targets: list
+        (collection, indexes) pairs, as returned by ``layout_indexes``.
+
+    Returns
+    -------
+    diff: dict
+        Maps 'database.collection' names to dicts with the names of the
+        indexes that are 'missing', the names of the indexes that exist but
+        have 'different' unique or sparse options, and the names of the
+        'extra' indexes that are not part of the layout.
+    """
+    diff = {}
+    for collection, indexes in targets:
+        existing = collection.index_information()
+        expected = {index_name(keys): options for keys, options in indexes}
+        missing = [name for name in expected if name not in existing]
+        different = [
+            name for name, options in expected.items()
+            if name in existing and any(
+                bool(options.get(option)) != bool(existing[name].get(option))
+                for option in ('unique', 'sparse'))]
+        extra = [name for name in existing
+                 if name not in expected and name != '_id_']
+        diff[_full_name(collection)] = {'missing': missing,
+                                        'different': different,
+                                        'extra': extra}
+    return diff
+
+
+def verify_indexes(targets):
+    """
+    Returns True if every index of the layout exists with the right options.
+
+    Indexes that are not part of the layout are allowed.
+    """
+    return not any(collection_diff['missing'] or collection_diff['different']
+                   for collection_diff in diff_indexes(targets).values())
+
+
+def build_indexes(targets, max_workers=4, progress=None):
+    """
+    Create the indexes of a layout.
+
+    Collections are built in parallel, the indexes of each collection one
+    after the other. Existing indexes are left as they are. Once built, the
+    indexes are recorded as ensured, so Serializers in this process do not
+    create them again.
+
+    Parameters
+    ----------
+    targets: list
+        (collection, indexes) pairs, as returned by ``layout_indexes``.
+    max_workers: int, optional
+        Maximum number of collections built at the same time. Default is 4.
+    progress: callable, optional
+        Called with a message after each index is built.
+    """
+    total = sum(len(indexes) for _, indexes in targets)
+    built = [0]
+    lock = threading.Lock()
+
+    def build(collection, indexes):
+        for keys, options in indexes:
+            collection.create_index(keys, **options)
+            with lock:
+                built[0] += 1
+                message = (f"[{built[0]}/{total}] built "
+                           f"{_full_name(collection)}.{index_name(keys)}")
+            if progress is not None:
+                progress(message)
+        _mark_ensured(collection, _freeze(indexes))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(build, collection, indexes)
+                   for collection, indexes in targets]
+    for future in futures:
+        future.result()
+
+
+def drop_indexes(targets, progress=None):
+    """
+    Drop the indexes of a layout that exist in the database.
+
+    Indexes that are not part of the layout, and the _id index, are kept.
+
+    Parameters
+    ----------
+    targets: list
+        (collection, indexes) pairs, as returned by ``layout_indexes``.
+    progress: callable, optional
+        Called with a message after each index is dropped.
+    """
+    for collection, indexes in targets:
+        existing = collection.index_information()
+        for keys, _ in indexes:
+            name = index_name(keys)
+            if name in existing:
+                collection.drop_index(name)
+                if progress is not None:
+                    progress(f"dropped {_full_name(collection)}.{name}")
+        clear_index_cache(collection)
+
+
+def _full_name(collection):
+    return f'{collection.database.name}.{collection.name}'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='suitcase-mongo-indexes',
+        description="Build, verify, diff or drop the indexes of a "
+                    "suitcase-mongo layout.")
+    parser.add_argument('action', choices=('build', 'verify', 'diff', 'drop'))
+    parser.add_argument('layout', choices=LAYOUTS)
+    parser.add_argument('uri', help="MongoDB URI of the embedded database or "
+                                    "of the normalized metadatastore "
+                                    "database, including the database name")
+    parser.add_argument('--asset-registry-uri',
+                        help="MongoDB URI of the normalized asset registry "
+                             "database. Defaults to uri.")
+    parser.add_argument('--resource-uid-unique', action='store_true',
+                        help="Make the normalized index on Resource uid "
+                             "unique.")
+    parser.add_argument('--max-workers', type=int, default=4,
+                        help="Maximum number of collections built at the "
+                             "same time.")
+    args = parser.parse_args(argv)
+
+    db = get_database(args.uri)
+    asset_registry_db = (get_database(args.asset_registry_uri)
+                         if args.asset_registry_uri else None)
+    targets = layout_indexes(args.layout, db, asset_registry_db,
+                             args.resource_uid_unique)
+
+    if args.action == 'build':
+        build_indexes(targets, max_workers=args.max_workers, progress=print)
+    elif args.action == 'drop':
+        drop_indexes(targets, progress=print)
+    else:
+        diff = diff_indexes(targets)
+        ok = True
+        for name, collection_diff in diff.items():
+            for kind, index_names in collection_diff.items():
+                for index in index_names:
+                    print(f"{kind:>9} {name}.{index}")
+            ok = ok and not (collection_diff['missing']
+                             or collection_diff['different'])
+        if args.action == 'verify':
+            print("OK" if ok else "FAILED")
+        return 0 if ok else 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,153 @@
+import uuid
+
+import bson
+import mongomock
+import numpy
+import pymongo
+import pytest
+
+from suitcase.mongo_utils import (
+    NUMPY_CODEC_OPTIONS, clear_index_cache, close_clients, contains_numpy,
+    ensure_indexes, get_client, get_database, has_numpy_codec, index_name,
+    with_numpy_codec)
+from suitcase.mongo_utils.indexes import (
+    build_indexes, diff_indexes, drop_indexes, layout_indexes, verify_indexes)
+
+INDEXES = [
+    ([('uid', pymongo.ASCENDING)], {'unique': True}),
+    ([('time', pymongo.DESCENDING), ('scan_id', pymongo.DESCENDING)], {}),
+]
+
+
+@pytest.fixture()
+def collection():
+    client = mongomock.MongoClient()
+    collection = client[f'test-{uuid.uuid4()}'].get_collection('run_start')
+    calls = []
+    create_index = collection.create_index
+
+    def counting_create_index(keys, **kwargs):
+        calls.append(keys)
+        return create_index(keys, **kwargs)
+
+    collection.create_index = counting_create_index
+    collection.create_index_calls = calls
+    yield collection
+    clear_index_cache()
+
+
+def test_ensure_indexes_cached(collection):
+    ensure_indexes(collection, INDEXES)
+    assert len(collection.create_index_calls) == 2
+    indexes = collection.index_information()
+    assert indexes['uid_1']['unique']
+    assert 'time_-1_scan_id_-1' in indexes
+
+    # The same index set is not created again...
+    ensure_indexes(collection, INDEXES)
+    assert len(collection.create_index_calls) == 2
+
+    # ...but a different one is.
+    ensure_indexes(collection, INDEXES[:1])
+    assert len(collection.create_index_calls) == 3
+
+
+def test_ensure_indexes_verify(collection):
+    collection.create_index([('uid', pymongo.ASCENDING)], unique=True)
+    ensure_indexes(collection, INDEXES, verify=True)
+    assert collection.create_index_calls[1:] == [INDEXES[1][0]]
+    assert 'time_-1_scan_id_-1' in collection.index_information()
+
+
+def test_index_name():
+    assert index_name([('uid', 1)]) == 'uid_1'
+    assert index_name([('$**', 'text')]) == '$**_text'
+    assert index_name(INDEXES[1][0]) == 'time_-1_scan_id_-1'
+
+
+@pytest.mark.parametrize('layout', ['normalized', 'embedded'])
+def test_manage_layout_indexes(layout):
+    client = mongomock.MongoClient()
+    db = client[f'test-{uuid.uuid4()}']
+    targets = layout_indexes(layout, db)
+    assert not verify_indexes(targets)
+
+    messages = []
+    build_indexes(targets, progress=messages.append)
+    total = sum(len(indexes) for _, indexes in targets)
+    assert len(messages) == total
+    assert verify_indexes(targets)
+    assert not any(diff['missing'] or diff['different'] or diff['extra']
+                   for diff in diff_indexes(targets).values())
+
+    collection, _ = targets[0]
+    collection.create_index('extra_field')
+    diff = diff_indexes(targets)[f'{db.name}.{collection.name}']
+    assert diff['extra'] == ['extra_field_1']
+    assert verify_indexes(targets)
+
+    drop_indexes(targets)
+    assert all(set(diff['missing']) == {index_name(keys)
+                                        for keys, _ in indexes}
+               for diff, (_, indexes)
+               in zip(diff_indexes(targets).values(), targets))
+    assert list(collection.index_information()) == ['_id_', 'extra_field_1']
+    clear_index_cache()
+
+
+def test_serializer_skips_indexes():
+    from suitcase.mongo_normalized import Serializer
+    client = mongomock.MongoClient()
+    db = client[f'test-{uuid.uuid4()}']
+    Serializer(db, db, create_indexes=False)
+    assert 'uid_1' not in db.run_start.index_information()
+
+
+def test_shared_clients():
+    # connect=False keeps the clients from trying to reach the hosts.
+    client = get_client('mongodb://h1:1,h2:2/db1?maxPoolSize=5',
+                        connect=False)
+    try:
+        assert get_client('mongodb://h2:2,h1:1/db2', maxPoolSize=5,
+                          connect=False) is client
+        assert get_database('mongodb://h1:1,h2:2/db3?maxPoolSize=5',
+                            connect=False).client is client
+        assert get_client('mongodb://h1:1,h2:2/db1?maxPoolSize=6',
+                          connect=False) is not client
+        assert get_client('mongodb://h1:1/db1?maxPoolSize=5',
+                          connect=False) is not client
+        with pytest.raises(ValueError):
+            get_database('mongodb://h1:1,h2:2/', connect=False)
+    finally:
+        close_clients()
+    assert get_client('mongodb://h1:1,h2:2/db1?maxPoolSize=5',
+                      connect=False) is not client
+    close_clients()
+
+
+def test_numpy_codec():
+    doc = {'data': {'x': numpy.arange(3.0), 'y': numpy.int64(1),
+                    'z': numpy.bool_(True)},
+           'shape': (2, [numpy.uint8(3)])}
+    assert contains_numpy(doc)
+    assert not contains_numpy({'data': {'x': [1.0, 2.0], 'y': 1},
+                               'shape': (2, [3])})
+    encoded = bson.encode(doc, codec_options=NUMPY_CODEC_OPTIONS)
+    assert bson.decode(encoded) == {'data': {'x': [0.0, 1.0, 2.0], 'y': 1,
+                                             'z': True},
+                                    'shape': [2, [3]]}
+    with pytest.raises(bson.errors.InvalidDocument):
+        bson.encode({'x': object()}, codec_options=NUMPY_CODEC_OPTIONS)
+
+    # connect=False keeps the client from trying to reach the host.
+    client = pymongo.MongoClient('mongodb://h1:1', connect=False)
+    try:
+        db = with_numpy_codec(client.db)
+        assert has_numpy_codec(db)
+        assert has_numpy_codec(db.event)
+    finally:
+        client.close()
+    # mongomock databases are left as they are.
+    db = mongomock.MongoClient()[f'test-{uuid.uuid4()}']
+    assert with_numpy_codec(db) is db
+    assert not has_numpy_codec(db)